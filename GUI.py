@@ -3,6 +3,8 @@ from tkinter import ttk
 import commonCladeSystem as ccs
 from commonCladeSystem import Node
 import pickle
+import queue
+import threading
 
 '''def outputText(text):
     outputArea["state"] = "normal"
@@ -10,45 +12,237 @@ import pickle
     outputArea.insert(1.0,text)
     outputArea["state"] = "disabled"'''
 
+# Changes made to the tree by the update thread, waiting to be shown in the Treeview by the Tk thread
+changes = queue.Queue()
 
-def loadTree(name="Sauria"):
+# When collapsing chains, any run of at least 'minChainLength' clades that each have one child is shown as a single row,
+# which can be double clicked to show the clades in it
+minChainLength = 3
+# Chain rows use the name of the last clade in the chain, so the clades below it go under it as usual.
+# 'chainStart' maps each chain row to the first clade in the chain and 'chainOf' maps every clade in a chain to its row.
+chainStart = {}
+chainOf = {}
+# Clades that have been expanded out of their chain, so they stay expanded when the tree is reloaded
+expanded = set()
+
+
+# Returns the children of a node that are in the tree
+def childrenIn(name):
+    return [child for child in ccs.treeDict[name].children if child in ccs.treeDict]
+
+
+# Returns the chain of clades starting at the given one, following single children down to the first clade that has
+# more or fewer than one, which ends the chain
+def chainFrom(name):
+    chain = [name]
+    children = childrenIn(name)
+    while len(children) == 1 and children[0] not in expanded:
+        chain.append(children[0])
+        children = childrenIn(children[0])
+    return chain
+
+
+def rowText(name):
     node = ccs.treeDict[name]
     text = name
+    if name in chainStart:
+        text = chainStart[name] + " … " + name
     if hasattr(node, "commonName") and node.commonName != "":
         text += " [" + node.commonName + "]"
+    if name in chainStart:
+        text += " (" + str(len(chainFrom(chainStart[name]))) + " clades)"
     if "genus" not in node.rank:
         text += " (" + str(ccs.countGenera(name)) + ")"
-    tree.insert(node.parent, 'end', name, text=text)
-    tree.set(name,"rank",node.rank)
-    for var in node.children:
+    return text
+
+
+def loadTree(name="Sauria"):
+    node = ccs.treeDict[name]
+    chain = chainFrom(name) if collapseChains.get() and name not in expanded else [name]
+    if len(chain) >= minChainLength:
+        name = chain[-1]
+        chainStart[name] = chain[0]
+        for var in chain:
+            chainOf[var] = name
+        rank = node.rank + " – " + ccs.treeDict[name].rank
+    else:
+        rank = node.rank
+    tree.insert(node.parent, 'end', name, text=rowText(name))
+    tree.set(name,"rank",rank)
+    for var in ccs.treeDict[name].children:
         loadTree(var)
 
-with open("tree.txt", "rb") as file:
-    treeTimeTuple = pickle.load(file)
-    ccs.loadData(treeTimeTuple)
 
-window = tk.Tk()
-window.geometry("1000x700")
+# Forgets the chains of rows that have been deleted
+def forgetChains():
+    for name in [name for name in chainStart if not tree.exists(name)]:
+        chainStart.pop(name)
+    for name in [name for name in chainOf if not tree.exists(chainOf[name])]:
+        chainOf.pop(name)
+
+
+# Shows the whole tree again, e.g. after switching chain collapsing on or off
+def reloadTree():
+    tree.delete(*tree.get_children("Neodiapsida"))
+    chainStart.clear()
+    chainOf.clear()
+    loadTree()
+
+
+# Loads a chain row again from the start of its chain, after the chain has been expanded or changed
+def reloadChain(name):
+    start = chainStart[name]
+    tree.delete(name)
+    forgetChains()
+    if start in ccs.treeDict and tree.exists(ccs.treeDict[start].parent):
+        loadTree(start)
+
+
+# Double clicking a chain row shows every clade in it as its own row
+def expandChain(event):
+    name = tree.identify_row(event.y)
+    if name in chainStart:
+        expanded.update(chainFrom(chainStart[name]))
+        reloadChain(name)
+
+
+# Called by commonCladeSystem on whichever thread changed the tree, so it only passes the change on to the Tk thread
+def queueChange(change, name, old=None):
+    changes.put((change, name, old))
+
+
+# Patches the rows affected by any changes that have come in, then checks again shortly.
+# The next check is always scheduled, so one bad change can't stop the tree from being updated for the rest of the session.
+def applyChanges():
+    try:
+        toRelabel = set()
+        with ccs.treeLock.reading():
+            while not changes.empty():
+                change, name, old = changes.get()
+                if change == "finished":
+                    status.set(name)
+                    updateButton["state"] = "normal"
+                    fullUpdateButton["state"] = "normal"
+                    continue
+                if change == "loaded":
+                    reloadTree()
+                    continue
+
+                # The node may have been removed since this was queued, in which case its "removed" change is still to come
+                if change in ["added", "moved", "rank", "commonName"] and name not in ccs.treeDict:
+                    continue
+
+                # A moved row is taken out first, as reloading a chain it has moved into would try to add it a second time
+                if change == "moved" and tree.exists(name) and name not in chainStart:
+                    tree.delete(name)
+                    forgetChains()
+
+                # A change to a clade in a chain, or to its parent or children, can make or break the chain,
+                # so the chain is loaded again instead of being patched
+                if change in ["added", "removed", "moved", "rank"]:
+                    parent = ccs.treeDict[name].parent if name in ccs.treeDict else None
+                    for chain in {chainOf[var] for var in [name, old, parent] if var in chainOf}:
+                        if tree.exists(chain):
+                            reloadChain(chain)
+
+                if change == "added":
+                    parent = ccs.treeDict[name].parent
+                    if tree.exists(parent) and not tree.exists(name) and name not in chainOf:
+                        loadTree(name)
+                    toRelabel.add(parent)
+                elif change == "removed":
+                    if tree.exists(name):
+                        tree.delete(name)
+                    toRelabel.add(old)
+                elif change == "moved":
+                    parent = ccs.treeDict[name].parent
+                    if tree.exists(name) and tree.exists(parent):
+                        tree.move(name, parent, 'end')
+                    elif tree.exists(name):
+                        tree.delete(name)
+                    elif tree.exists(parent) and name not in chainOf:
+                        loadTree(name)
+                    toRelabel.add(old)
+                    toRelabel.add(parent)
+                elif change == "rank":
+                    if tree.exists(name) and name not in chainStart:
+                        tree.set(name, "rank", ccs.treeDict[name].rank)
+                    toRelabel.add(ccs.treeDict[name].parent)
+                if change in ["added", "moved", "rank", "commonName"]:
+                    toRelabel.add(name)
+
+            # Genus counts change all the way up the tree, so every affected row is relabelled once per batch of changes
+            relabelled = set()
+            for name in toRelabel:
+                while name in ccs.treeDict and name not in relabelled:
+                    relabelled.add(name)
+                    if tree.exists(name):
+                        tree.item(name, text=rowText(name))
+                    name = ccs.treeDict[name].parent
+    finally:
+        window.after(200, applyChanges)
+
+
+# Runs an update from commonCladeSystem on a separate thread, so the window keeps responding while it downloads
+# Tk can only be used from its own thread, so the result is sent back through the queue of changes
+def startUpdate(function, *args):
+    def run():
+        try:
+            function(*args)
+            changes.put(("finished", "Update finished", None))
+        except Exception as e:
+            changes.put(("finished", f"Update failed: {e}", None))
+
+    updateButton["state"] = "disabled"
+    fullUpdateButton["state"] = "disabled"
+    status.set("Updating...")
+    threading.Thread(target=run, daemon=True).start()
+
+
+# Only run when started as a script. On Windows, worker processes (such as the pool that parses pages) import the main
+# module again, and without this each of them would load the tree and open a window of its own.
+if __name__ == "__main__":
+    ccs.importTree()
+    ccs.addChangeListener(queueChange)
+
+    window = tk.Tk()
+    window.geometry("1000x700")
+
+    window.rowconfigure(0, weight=1)
+    window.columnconfigure(0, weight=1)
+
+    tree = ttk.Treeview(window, height=10, columns="rank")
+    tree.grid(row=0, column=0, sticky=tk.NSEW)
 
-window.rowconfigure(0, weight=1)
-window.columnconfigure(0, weight=1)
+    tree.column("#0", width=0, stretch = True, minwidth=80)
+    tree.column("rank", width=100)
+    tree.heading("#0", text="Tree of Sauria")
+    tree.heading("rank", text="Rank")
 
-tree = ttk.Treeview(window, height=10, columns="rank")
-tree.grid(row=0, column=0, sticky=tk.NSEW)
+    scrollHoriz = ttk.Scrollbar(window, orient=tk.HORIZONTAL, command=tree.xview)
+    scrollVert = ttk.Scrollbar(window, orient=tk.VERTICAL, command=tree.yview)
+    scrollHoriz.grid(row=1,column=0,sticky=tk.EW)
+    scrollVert.grid(row=0,column=1,sticky=tk.NS)
+    tree.configure(xscrollcommand=scrollHoriz.set, yscrollcommand=scrollVert.set)
 
-tree.column("#0", width=0, stretch = True, minwidth=80)
-tree.column("rank", width=100)
-tree.heading("#0", text="Tree of Sauria")
-tree.heading("rank", text="Rank")
+    controls = ttk.Frame(window)
+    controls.grid(row=2, column=0, columnspan=2, sticky=tk.EW)
+    cladeEntry = ttk.Entry(controls)
+    cladeEntry.pack(side=tk.LEFT)
+    updateButton = ttk.Button(controls, text="Update clade", command=lambda: startUpdate(ccs.forceUpdate, cladeEntry.get()))
+    updateButton.pack(side=tk.LEFT)
+    fullUpdateButton = ttk.Button(controls, text="Full update", command=lambda: startUpdate(ccs.fullUpdate))
+    fullUpdateButton.pack(side=tk.LEFT)
+    status = tk.StringVar()
+    ttk.Label(controls, textvariable=status).pack(side=tk.LEFT)
 
-scrollHoriz = ttk.Scrollbar(window, orient=tk.HORIZONTAL, command=tree.xview)
-scrollVert = ttk.Scrollbar(window, orient=tk.VERTICAL, command=tree.yview)
-scrollHoriz.grid(row=1,column=0,sticky=tk.EW)
-scrollVert.grid(row=0,column=1,sticky=tk.NS)
-tree.configure(xscrollcommand=scrollHoriz.set, yscrollcommand=scrollVert.set)
+    collapseChains = tk.BooleanVar(value=True)
+    ttk.Checkbutton(controls, text="Collapse chains", variable=collapseChains, command=reloadTree).pack(side=tk.LEFT)
+    tree.bind("<Double-1>", expandChain)
 
-tree.insert('', 0, "Neodiapsida", text="Neodiapsida")
-loadTree()
+    tree.insert('', 0, "Neodiapsida", text="Neodiapsida")
+    loadTree()
+    window.after(200, applyChanges)
 
-# DO NOT WRITE CODE AFTER THIS
-window.mainloop()
+    # DO NOT WRITE CODE AFTER THIS
+    window.mainloop()
@@ -3,14 +3,97 @@ import requests
 import pickle
 import atexit
 import feedparser
-import sys
+import os
 import re
-from datetime import datetime
+import json
+import bisect
+import unicodedata
+import threading
+import multiprocessing
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from datetime import datetime, timedelta
+from frontier import Frontier
+from refreshScheduler import RefreshScheduler
+from treeHistory import TreeHistory, HISTORY_FILE
+from treeShape import childrenByParent
+from taxonParsing import replacements, cleanPageName, cleanRank, taxonDataFromPage, extinctFromPage, speciesFromPage, extractRecord, extractRecords
 
 # Default values
 treeDict = {}
+treeLoaded = False  # Set once a tree has been loaded, so that an empty tree is never saved over a real one
 lastUpdated = "2000-01-01T00:00:00Z"
 API_URL = "https://en.wikipedia.org/w/api.php"
+TREE_FILE = "tree.txt"
+FRONTIER_FILE = "frontier.db"
+
+# The pages whose subtrees fullUpdate crawls. /skip templates found along the way are crawled automatically.
+defaultRoots = ["Vertebrata", "Aves", "Aves/skip"]  # remove Aves once we get to Chordata
+
+# How many items fullUpdate gets through between saving a checkpoint
+checkpointInterval = 250
+sinceCheckpoint = 0
+
+
+# The state of any update that is in progress, saved alongside the tree so an interrupted run can be resumed.
+# 'fullUpdate' tracks how far fullUpdate got. The progress of crawls is kept in the frontier file instead.
+def newCrawlState():
+    return {"fullUpdate": None}
+
+
+crawlState = newCrawlState()
+
+# A lock that lets any number of threads read the tree at the same time, but only lets one thread change it, with nobody reading.
+# The thread changing the tree can take it again, so functions that change the tree can call each other,
+# and can read while it is writing. Network requests are made outside of it, so readers are never held up for long.
+class TreeLock:
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.readers = 0
+        self.writer = None
+        self.depth = 0
+
+    @contextmanager
+    def reading(self):
+        counted = False
+        with self.condition:
+            if self.writer != threading.get_ident():
+                while self.writer is not None:
+                    self.condition.wait()
+                self.readers += 1
+                counted = True
+        try:
+            yield
+        finally:
+            if counted:
+                with self.condition:
+                    self.readers -= 1
+                    self.condition.notify_all()
+
+    @contextmanager
+    def writing(self):
+        with self.condition:
+            if self.writer != threading.get_ident():
+                while self.writer is not None or self.readers > 0:
+                    self.condition.wait()
+                self.writer = threading.get_ident()
+            self.depth += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.depth -= 1
+                if self.depth == 0:
+                    self.writer = None
+                    self.condition.notify_all()
+
+
+treeLock = TreeLock()
+
+# Functions to be called whenever the tree changes. Each one is given the type of change, the name of the node and the old value.
+# The types are "added", "removed", "moved", "rank", "extinct", "commonName" and "loaded" (when a whole new tree is loaded in).
+# They are called from whichever thread made the change, while it holds treeLock for writing.
+changeListeners = []
 
 
 # A class to represent each part of the 'tree'. A node is either a genus or a clade.
@@ -97,19 +180,595 @@ aliases = {
 }
 commonNames = {}
 
-# Wikipedia uses latin names for ranks in their templates, so this is needed when anglicising rank names.
-replacements = {
-    "regnum": "kingdom",
-    "cladus": "clade",
-    "classis": "class",
-    "familia": "family",
-    "ordo": "order",
-    "tribus": "tribe",
-    "divisio": "division",
-}
-
-# Things that break this. Fix later.
-dumbStuff = []
+# Pages that have failed before, so that they aren't downloaded and failed on again every run.
+# Each title maps to the reason it failed, the revision of the page at the time (None if it didn't exist),
+# how many times in a row it has failed and when it can next be tried. Entries expire when the page's revision changes.
+negativeCache = {}
+negativeRetryDays = 7
+
+# The latest revision ID seen for each page downloaded recently, used to expire entries in 'negativeCache'
+recentRevisions = {}
+maxRecentRevisions = 50000
+
+# Pages downloaded in bulk are parsed by this many worker processes, so parsing isn't held to one core. 0 parses them here.
+parseWorkers = os.cpu_count() or 1
+parsePool = None
+
+# Every save of the tree is recorded in the history, as the changes since the last save
+recordHistory = True
+treeHistory = None
+
+# Keeps track of how often each node's template is edited, so scheduledUpdate can check busy parts of the tree more often
+refreshScheduler = RefreshScheduler()
+
+
+# Registers a function to be called whenever the tree changes
+def addChangeListener(listener):
+    if listener not in changeListeners:
+        changeListeners.append(listener)
+
+
+# Stops a function from being called when the tree changes
+def removeChangeListener(listener):
+    if listener in changeListeners:
+        changeListeners.remove(listener)
+
+
+# Tells everything listening that a node has changed
+def notifyChange(change, name, old=None):
+    for listener in changeListeners:
+        listener(change, name, old)
+
+
+# The ranks shown by printTaxonTree when only the main ranks are wanted
+mainRanks = ["kingdom", "phylum", "class", "order", "family", "genus", "species"]
+
+# Ranks that count as members of a clade in their own right, so they are kept in the extant view even with no children
+memberRanks = ["genus", "subgenus", "species", "subspecies"]
+
+
+# The children of every node, going by the nodes' parents, as worked out by treeShape.childrenByParent.
+# The views and indexes below are built from this, so nothing in the tree is left out of them.
+# The map is built the first time it is used and is then kept up to date as the tree changes.
+class ChildMap:
+    def __init__(self):
+        self.built = False
+        self.children = {}
+        addChangeListener(self.onChange)
+
+    def ensureBuilt(self):
+        if not self.built:
+            self.build()
+
+    def build(self):
+        self.children = childrenByParent(treeDict)
+        self.built = True
+
+    def childrenOf(self, name):
+        self.ensureBuilt()
+        return self.children.get(name, [])
+
+    def add(self, name, parent):
+        children = self.children.setdefault(parent, [])
+        if name not in children:
+            children.append(name)
+
+    def remove(self, name, parent):
+        if name in self.children.get(parent, []):
+            self.children[parent].remove(name)
+
+    def onChange(self, change, name, old=None):
+        if change == "loaded":
+            self.built = False
+        if not self.built:
+            return
+        if change == "added":
+            self.children.setdefault(name, [])
+            self.add(name, treeDict[name].parent)
+        elif change == "removed":
+            self.remove(name, old)
+        elif change == "moved":
+            self.remove(name, old)
+            self.add(name, treeDict[name].parent)
+
+
+# A materialised view of the tree containing only the extant parts of it.
+# A node is kept if it is not extinct and it is a genus or lower, has no children, or has a kept child,
+# so clades that are extant in name but only contain extinct taxa are pruned.
+# The view is built the first time it is used and is then kept up to date as the tree changes.
+class ExtantView:
+    def __init__(self):
+        self.built = False
+        self.keep = {}
+        self.children = {}
+        addChangeListener(self.onChange)
+
+    def isKept(self, name):
+        self.ensureBuilt()
+        return self.keep.get(name, False)
+
+    def childrenOf(self, name):
+        self.ensureBuilt()
+        return self.children.get(name, [])
+
+    def ensureBuilt(self):
+        if not self.built:
+            self.build()
+
+    def build(self):
+        self.keep = {}
+        self.children = {}
+        # Every node is pushed once and popped twice, so its children are all worked out before it is
+        for root in [name for name in treeDict if treeDict[name].parent not in treeDict]:
+            stack = [(root, False)]
+            while stack:
+                name, finished = stack.pop()
+                if finished:
+                    self.recompute(name)
+                else:
+                    stack.append((name, True))
+                    stack.extend((child, False) for child in treeChildren.childrenOf(name))
+        self.built = True
+
+    # Works out whether a single node is kept from its children, returning whether that has changed
+    def recompute(self, name):
+        node = treeDict[name]
+        children = treeChildren.childrenOf(name)
+        self.children[name] = [child for child in children if self.keep.get(child, False)]
+        kept = not getattr(node, "extinct", False) and (node.rank in memberRanks or len(children) == 0 or len(self.children[name]) > 0)
+        changed = kept != self.keep.get(name)
+        self.keep[name] = kept
+        return changed
+
+    # Recomputes a node, then carries on up the tree for as long as nodes are being added to or removed from the view
+    def updateFrom(self, name):
+        while name in treeDict:
+            if not self.recompute(name):
+                break
+            name = treeDict[name].parent
+
+    def onChange(self, change, name, old=None):
+        if change == "loaded":
+            self.built = False
+        if not self.built:
+            return
+        if change == "added":
+            self.recompute(name)
+            self.updateFrom(treeDict[name].parent)
+        elif change == "removed":
+            self.keep.pop(name, None)
+            self.children.pop(name, None)
+            self.updateFrom(old)
+        elif change == "moved":
+            self.updateFrom(old)
+            self.updateFrom(treeDict[name].parent)
+        elif change == "extinct" or change == "rank":
+            self.updateFrom(name)
+
+
+# A materialised view linking every node to its nearest ancestor with one of the main ranks,
+# along with the main rank nodes directly below each node in that sense.
+# The view is built the first time it is used and is then kept up to date as the tree changes.
+class MainRanksView:
+    def __init__(self):
+        self.built = False
+        self.mainParent = {}
+        self.mainChildren = {}
+        addChangeListener(self.onChange)
+
+    # Returns the main rank ancestors of a node, starting with the closest
+    def lineage(self, name):
+        self.ensureBuilt()
+        output = []
+        name = self.mainParent.get(name, "")
+        while name != "":
+            output.append(name)
+            name = self.mainParent.get(name, "")
+        return output
+
+    def childrenOf(self, name):
+        self.ensureBuilt()
+        return self.mainChildren.get(name, [])
+
+    def ensureBuilt(self):
+        if not self.built:
+            self.build()
+
+    def build(self):
+        self.mainParent = {}
+        self.mainChildren = {}
+        for root in [name for name in treeDict if treeDict[name].parent not in treeDict]:
+            stack = [root]
+            while stack:
+                name = stack.pop()
+                self.relink(name)
+                stack.extend(reversed(treeChildren.childrenOf(name)))
+        self.built = True
+
+    # Works out the main rank parent of a single node from its actual parent
+    def relink(self, name):
+        parent = treeDict[name].parent
+        if parent not in treeDict:
+            newParent = ""
+        elif treeDict[parent].rank in mainRanks:
+            newParent = parent
+        else:
+            newParent = self.mainParent.get(parent, "")
+        oldParent = self.mainParent.get(name)
+        if oldParent is not None and name in self.mainChildren.get(oldParent, []):
+            self.mainChildren[oldParent].remove(name)
+        self.mainParent[name] = newParent
+        if treeDict[name].rank in mainRanks:
+            self.mainChildren.setdefault(newParent, []).append(name)
+
+    # Relinks a node and everything below it, down to the next main rank nodes, whose links can't have changed
+    def relinkSubtree(self, name):
+        self.relink(name)
+        stack = list(treeChildren.childrenOf(name))
+        while stack:
+            child = stack.pop()
+            self.relink(child)
+            if treeDict[child].rank not in mainRanks:
+                stack.extend(treeChildren.childrenOf(child))
+
+    def onChange(self, change, name, old=None):
+        if change == "loaded":
+            self.built = False
+        if not self.built:
+            return
+        if change == "added":
+            self.relink(name)
+        elif change == "removed":
+            oldParent = self.mainParent.pop(name, "")
+            if name in self.mainChildren.get(oldParent, []):
+                self.mainChildren[oldParent].remove(name)
+            self.mainChildren.pop(name, None)
+        elif change == "moved" or change == "rank":
+            self.relinkSubtree(name)
+
+
+# Splits a common name into lowercase words without accents, e.g. "Nile crocodile" -> ["nile", "crocodile"]
+def commonNameTokens(commonName):
+    text = unicodedata.normalize("NFKD", commonName).encode("ascii", "ignore").decode().lower()
+    return re.findall("[a-z0-9]+", text)
+
+
+# An inverted index from the words in common names to the common names containing them, mirroring 'commonNames'.
+# The words are also kept sorted so that every word starting with a prefix can be found with a binary search.
+# The index is built the first time it is used and is then kept up to date as common names are registered and removed.
+class CommonNameIndex:
+    def __init__(self):
+        self.built = False
+        self.names = {}
+        self.words = []
+        addChangeListener(self.onChange)
+
+    def ensureBuilt(self):
+        if not self.built:
+            self.build()
+
+    def build(self):
+        self.names = {}
+        self.words = []
+        for commonName in commonNames:
+            self.add(commonName)
+        self.built = True
+
+    def add(self, commonName):
+        for word in commonNameTokens(commonName):
+            if word not in self.names:
+                self.names[word] = set()
+                bisect.insort(self.words, word)
+            self.names[word].add(commonName)
+
+    def remove(self, commonName):
+        for word in commonNameTokens(commonName):
+            if word in self.names:
+                self.names[word].discard(commonName)
+                if len(self.names[word]) == 0:
+                    del self.names[word]
+                    self.words.pop(bisect.bisect_left(self.words, word))
+
+    # Returns the common names containing a word, or any word starting with it if 'prefix' is true
+    def namesWith(self, word, prefix=False):
+        if not prefix:
+            return set(self.names.get(word, set()))
+        output = set()
+        position = bisect.bisect_left(self.words, word)
+        while position < len(self.words) and self.words[position].startswith(word):
+            output |= self.names[self.words[position]]
+            position += 1
+        return output
+
+    # Returns (taxon, common name) pairs for common names containing every word of 'text', sorted by common name.
+    # With 'prefix', the last word only has to start a word. With 'under', only taxa below that clade are included.
+    def search(self, text, prefix=False, under=""):
+        self.ensureBuilt()
+        words = commonNameTokens(text)
+        if len(words) == 0:
+            return []
+        found = self.namesWith(words[-1], prefix)
+        for word in words[:-1]:
+            found &= self.namesWith(word)
+        output = []
+        for commonName in sorted(found):
+            taxon = commonNames[commonName]
+            if under == "" or subtreeIndex.isUnder(taxon, under):
+                output.append((taxon, commonName))
+        return output
+
+    def onChange(self, change, name, old=None):
+        if change == "loaded":
+            self.built = False
+        if not self.built or change != "commonName":
+            return
+        if old and old not in commonNames:
+            self.remove(old)
+        commonName = treeDict[name].commonName
+        if commonName != "" and commonNames.get(commonName) == name:
+            self.add(commonName)
+
+
+# The ranks that RankAncestorIndex keeps a direct link to
+ancestorRanks = ["kingdom", "phylum", "class", "order", "family", "tribe", "genus"]
+
+
+# An index giving, for every node, its nearest ancestor at each of the ranks in 'ancestorRanks'.
+# Each node holds a tuple with one name per rank ("" where there is none), and a node counts as its own ancestor,
+# so the family of a family is itself. Ranks are compared after going through cleanRank, so older saves work too.
+# The index is built the first time it is used and is then kept up to date as the tree changes.
+class RankAncestorIndex:
+    def __init__(self):
+        self.built = False
+        self.ancestors = {}
+        addChangeListener(self.onChange)
+
+    def ensureBuilt(self):
+        if not self.built:
+            self.build()
+
+    def build(self):
+        self.ancestors = {}
+        for root in [name for name in treeDict if treeDict[name].parent not in treeDict]:
+            self.relinkSubtree(root)
+        self.built = True
+
+    # Works out the tuple of a single node from its parent's
+    def relink(self, name):
+        node = treeDict[name]
+        ancestors = self.ancestors.get(node.parent, ("",) * len(ancestorRanks))
+        rank = cleanRank(node.rank).lower()
+        if rank in ancestorRanks:
+            position = ancestorRanks.index(rank)
+            ancestors = ancestors[:position] + (name,) + ancestors[position + 1:]
+        self.ancestors[name] = ancestors
+
+    # Relinks a node and everything below it, as all of their tuples come from this node's
+    def relinkSubtree(self, name):
+        stack = [name]
+        while stack:
+            name = stack.pop()
+            self.relink(name)
+            stack.extend(treeChildren.childrenOf(name))
+
+    # Returns the nearest ancestor of a node with the given rank, or "" if there isn't one
+    def ancestor(self, name, rank):
+        self.ensureBuilt()
+        return self.ancestors[name][ancestorRanks.index(rank)]
+
+    # Groups a list of taxa by their ancestor with the given rank, returning a dictionary of ancestor to taxa.
+    # Aliases and common names are followed. Taxa with no ancestor of that rank go under "" and unknown ones under None.
+    def group(self, taxa, rank="family"):
+        self.ensureBuilt()
+        position = ancestorRanks.index(rank)
+        output = {}
+        for taxon in taxa:
+            name = cleanPageName(taxon)
+            if name not in treeDict:
+                name = aliases.get(name, commonNames.get(name, name))
+            key = self.ancestors[name][position] if name in self.ancestors else None
+            output.setdefault(key, []).append(taxon)
+        return output
+
+    def onChange(self, change, name, old=None):
+        if change == "loaded":
+            self.built = False
+        if not self.built:
+            return
+        if change == "added":
+            self.relink(name)
+        elif change == "removed":
+            self.ancestors.pop(name, None)
+        elif change == "moved" or change == "rank":
+            self.relinkSubtree(name)
+
+
+# Numbers every node in pre-order, following the parent pointers (through treeChildren), so everything below a node is the interval
+# [pre, pre + size) and "is A under B" is two comparisons. The position of every node of each rank is kept in a sorted
+# list, so everything of one rank under a node is a slice found by binary search, in time proportional to the result.
+# listGenera and countGenera don't look inside genera, so nodes also keep how many genera are above them (or are them),
+# for leaving out any genera that are inside another genus.
+# Built the first time it's needed, and rebuilt the next time after the shape of the tree or any rank changes.
+class SubtreeIndex:
+    def __init__(self):
+        self.built = False
+        self.pre = {}
+        self.size = {}
+        self.order = []
+        self.byRank = {}
+        self.generaAbove = {}  # Counts nodes with rank "genus", as listGenera does
+        self.genusLikeAbove = {}  # Counts nodes with "genus" anywhere in their rank, as countGenera does
+        self.genusLikeLevels = {}  # Number of genus-like nodes above (including itself) -> positions of genus-like nodes
+        self.nonGenusChildren = {}
+        addChangeListener(self.onChange)
+
+    def ensureBuilt(self):
+        if not self.built:
+            self.build()
+
+    def build(self):
+        self.pre = {}
+        self.size = {}
+        self.order = []
+        self.byRank = {}
+        self.generaAbove = {}
+        self.genusLikeAbove = {}
+        self.genusLikeLevels = {}
+        self.nonGenusChildren = {}
+        for root in [name for name in treeDict if treeDict[name].parent not in treeDict]:
+            stack = [(root, False, 0, 0)]
+            while stack:
+                name, finished, genera, genusLike = stack.pop()
+                if finished:
+                    self.size[name] = len(self.order) - self.pre[name]
+                    continue
+                if name in self.pre:
+                    continue
+                node = treeDict[name]
+                if node.rank == "genus":
+                    genera += 1
+                if "genus" in node.rank:
+                    genusLike += 1
+                    self.genusLikeLevels.setdefault(genusLike, []).append(len(self.order))
+                self.pre[name] = len(self.order)
+                self.order.append(name)
+                self.byRank.setdefault(node.rank, []).append(self.pre[name])
+                self.generaAbove[name] = genera
+                self.genusLikeAbove[name] = genusLike
+                children = treeChildren.childrenOf(name)
+                self.nonGenusChildren[name] = [child for child in children if treeDict[child].rank != "genus"]
+                stack.append((name, True, genera, genusLike))
+                stack.extend((child, False, genera, genusLike) for child in reversed(children))
+        self.built = True
+
+    # Returns the positions in a sorted list that are strictly below the given node
+    def below(self, positions, name):
+        start = bisect.bisect_right(positions, self.pre[name])
+        end = bisect.bisect_left(positions, self.pre[name] + self.size[name], start)
+        return start, end
+
+    # Returns whether 'name' is 'ancestor' or somewhere below it
+    def isUnder(self, name, ancestor):
+        self.ensureBuilt()
+        if name not in self.pre or ancestor not in self.pre:
+            return False
+        return self.pre[ancestor] <= self.pre[name] < self.pre[ancestor] + self.size[ancestor]
+
+    # Returns every node of the given rank below the given node, in the same order as the tree
+    def listUnder(self, name, rank):
+        self.ensureBuilt()
+        positions = self.byRank.get(rank, [])
+        start, end = self.below(positions, name)
+        return [self.order[position] for position in positions[start:end]]
+
+    # Returns the genera below the given node that aren't inside another genus below it
+    def genera(self, name):
+        self.ensureBuilt()
+        level = self.generaAbove[name] + 1
+        return [genus for genus in self.listUnder(name, "genus") if self.generaAbove[genus] == level]
+
+    # Returns how many nodes with "genus" in their rank are below the given node, without counting any inside another one
+    def countGenusLike(self, name):
+        self.ensureBuilt()
+        start, end = self.below(self.genusLikeLevels.get(self.genusLikeAbove[name] + 1, []), name)
+        return end - start
+
+    def childrenWithoutGenera(self, name):
+        self.ensureBuilt()
+        return self.nonGenusChildren[name]
+
+    def onChange(self, change, name, old=None):
+        if change in ["loaded", "added", "removed", "moved", "rank"]:
+            self.built = False
+
+
+# Returns the trigrams of a name, ignoring case, accents and punctuation, with the ends padded so that they count as well
+def nameTrigrams(name):
+    text = "  " + " ".join(commonNameTokens(name)) + " "
+    return {text[var:var + 3] for var in range(len(text) - 2)}
+
+
+# A trigram index over every taxon name, alias and common name, for suggesting what a misspelt or unknown name might
+# have meant without going to Wikipedia. Names are scored by how many trigrams they share with what was asked for.
+# The index is built the first time it is used and is then kept up to date as nodes and common names change.
+class FuzzyIndex:
+    def __init__(self):
+        self.built = False
+        self.trigrams = {}
+        self.targets = {}  # Each name in the index -> the taxon it leads to
+        self.sizes = {}  # Each name in the index -> how many trigrams it has
+        addChangeListener(self.onChange)
+
+    def ensureBuilt(self):
+        if not self.built:
+            self.build()
+
+    def build(self):
+        self.trigrams = {}
+        self.targets = {}
+        self.sizes = {}
+        for name in treeDict:
+            self.add(name, name)
+        for alias in aliases:
+            self.add(alias, aliases[alias])
+        for commonName in commonNames:
+            self.add(commonName, commonNames[commonName])
+        self.built = True
+
+    def add(self, name, target):
+        self.targets[name] = target
+        trigrams = nameTrigrams(name)
+        self.sizes[name] = len(trigrams)
+        for trigram in trigrams:
+            self.trigrams.setdefault(trigram, set()).add(name)
+
+    def remove(self, name):
+        if self.targets.pop(name, None) is not None:
+            self.sizes.pop(name)
+            for trigram in nameTrigrams(name):
+                self.trigrams[trigram].discard(name)
+
+    # Returns up to 'limit' (name, taxon, score) tuples for the names closest to the given one, best first.
+    # The score is the Dice coefficient of the two names' trigrams, from 0 to 1, and anything under 'minimum' is left out.
+    def suggest(self, name, limit=5, minimum=0.4):
+        self.ensureBuilt()
+        trigrams = nameTrigrams(name)
+        shared = {}
+        for trigram in trigrams:
+            for match in self.trigrams.get(trigram, ()):
+                shared[match] = shared.get(match, 0) + 1
+        scored = []
+        for match, count in shared.items():
+            score = 2 * count / (len(trigrams) + self.sizes[match])
+            if score >= minimum:
+                scored.append((-score, match))
+        scored.sort()
+        return [(match, self.targets[match], -score) for score, match in scored[:limit]]
+
+    def onChange(self, change, name, old=None):
+        if change == "loaded":
+            self.built = False
+        if not self.built:
+            return
+        if change == "added":
+            self.add(name, name)
+        elif change == "removed":
+            self.remove(name)
+        elif change == "commonName":
+            if old is not None and old != "":
+                self.remove(old)
+            commonName = getattr(treeDict[name], "commonName", "") if name in treeDict else ""
+            if commonName != "":
+                self.add(commonName, name)
+
+
+treeChildren = ChildMap()
+extantView = ExtantView()
+mainRanksView = MainRanksView()
+commonNameIndex = CommonNameIndex()
+rankAncestorIndex = RankAncestorIndex()
+subtreeIndex = SubtreeIndex()
+fuzzyIndex = FuzzyIndex()
 
 
 # This puts the data in its correct place for processing
@@ -117,31 +776,177 @@ def loadData(fileTuple):
     global lastUpdated
     global treeDict
     global commonNames
-    lastUpdated = fileTuple[0]
-    treeDict = fileTuple[1]
-    try:
-        commonNames = fileTuple[2]
-    except:
-        pass
+    global crawlState
+    global treeLoaded
+    with treeLock.writing():
+        treeLoaded = True
+        lastUpdated = fileTuple[0]
+        treeDict = fileTuple[1]
+        try:
+            commonNames = fileTuple[2]
+        except:
+            pass
+        try:
+            extraData = fileTuple[3]
+        except IndexError:
+            extraData = {}
+        crawlState = extraData.get("crawlState", newCrawlState())
+        negativeCache.clear()
+        negativeCache.update(extraData.get("negativeCache", {}))
+        refreshScheduler.load(extraData.get("refreshSchedule", {}))
+        notifyChange("loaded", "")
+
+
+# Returns everything that is saved, in the form loadData takes
+def currentData():
+    extraData = {"crawlState": crawlState, "negativeCache": negativeCache, "refreshSchedule": refreshScheduler.getState()}
+    return lastUpdated, treeDict, commonNames, extraData
+
+
+# Writes the tree and the crawl state to a file.
+# The data is written to a temporary file first so that being interrupted mid-save can't corrupt the old tree.
+# Nothing is saved unless a tree was loaded with loadData, so a script that never loads one (e.g. one that only diffs
+# saved files) can't save an empty tree over the real one when it exits.
+# Saves of tree.txt are recorded in the history, apart from checkpoints, which pass 'recordVersion' as False.
+def saveTree(fileName=TREE_FILE, recordVersion=True):
+    if not treeLoaded:
+        print("No tree has been loaded, so nothing was saved")
+        return
+    fileTuple = currentData()
+    with treeLock.reading():
+        with open(fileName + ".tmp", "wb") as file:
+            pickle.dump(fileTuple, file, pickle.HIGHEST_PROTOCOL)
+        os.replace(fileName + ".tmp", fileName)
+        # The history is only recorded once the tree is safely saved, and a problem with it (e.g. history.db being locked
+        # by another process) is only reported, so it can never stop the tree being saved
+        if recordHistory and recordVersion and fileName == TREE_FILE:
+            try:
+                getHistory().record(datetime.now().isoformat()[:19] + "Z", treeDict)
+            except Exception as e:
+                print(f"The tree was saved, but couldn't be recorded in the history: {e}")
+
+
+# Returns the history of the tree, opening it the first time it's needed
+def getHistory():
+    global treeHistory
+    if treeHistory is None:
+        treeHistory = TreeHistory(HISTORY_FILE)
+    return treeHistory
+
+
+# Adds the dated trees in Backup/ to the history, so they don't need keeping as full copies
+def importBackups(folder="Backup"):
+    trees = []
+    for fileName in sorted(os.listdir(folder)):
+        if fileName.endswith(".txt"):
+            trees.append((fileName[:-4], readTreeFile(os.path.join(folder, fileName))[1]))
+    getHistory().insert(trees)
+    print(f"Added {str(len(trees))} backups to the history")
+
+
+# Returns (treeDict, commonNames) as they were on the given date, e.g. treeAsOf("2021-04-10"), without loading it
+def treeAsOf(date):
+    return getHistory().treeAsOf(date, Node)
+
+
+# Saves a checkpoint of the tree and resets the counter
+def checkpoint():
+    global sinceCheckpoint
+    sinceCheckpoint = 0
+    saveTree(recordVersion=False)
+    print("Checkpoint saved")
+
+
+# Counts one processed item, saving a checkpoint every 'checkpointInterval' items. Returns whether one was saved.
+def tickCheckpoint():
+    global sinceCheckpoint
+    sinceCheckpoint += 1
+    if sinceCheckpoint >= checkpointInterval:
+        checkpoint()
+        return True
+    return False
 
 
 # This ensures that the tree is saved every time the program closes
+# Worker processes can load this file too, but only the process that owns the tree should save it
 def exitHandler():
-    global treeDict
-    fileTuple = (lastUpdated, treeDict, commonNames)
-    with open("tree.txt", "wb") as file:
-        pickle.dump(fileTuple, file, pickle.HIGHEST_PROTOCOL)
+    if multiprocessing.parent_process() is None:
+        saveTree()
 
 
 atexit.register(exitHandler)
 
 
+# Records that a page failed, so it isn't tried again until its retry time or until the page is edited.
+# Every failure in a row doubles the wait before the next try, up to 16 times 'negativeRetryDays'.
+def recordFailure(title, reason, revision=None):
+    if revision is None:
+        revision = recentRevisions.get(title)
+    failures = negativeCache[title]["failures"] + 1 if title in negativeCache else 1
+    retryAfter = datetime.now() + timedelta(days=negativeRetryDays * 2 ** min(failures - 1, 4))
+    negativeCache[title] = {"reason": reason, "revision": revision, "failures": failures,
+                            "retryAfter": retryAfter.isoformat()[:-7] + "Z"}
+    print(f"Recorded failure for {title}: {reason}")
+
+
+# Remembers the revision of a page that has just been downloaded, forgetting older ones once there are too many
+def noteRevision(title, revision):
+    if len(recentRevisions) >= maxRecentRevisions:
+        recentRevisions.clear()
+    recentRevisions[title] = revision
+
+
+# Forgets that a page has failed
+def clearFailure(title):
+    negativeCache.pop(title, None)
+
+
+# Returns whether a page is known to fail, so that it shouldn't be downloaded.
+# Entries are dropped as soon as a different revision of the page is seen, and are not used after their retry time.
+def isNegativeCached(title):
+    if title not in negativeCache:
+        return False
+    entry = negativeCache[title]
+    if title in recentRevisions and recentRevisions[title] != entry["revision"]:
+        clearFailure(title)
+        return False
+    return datetime.now().isoformat()[:-7] + "Z" < entry["retryAfter"]
+
+
+# Checks the current revision of every page in the negative cache, 50 at a time, and drops those that have been edited
+# (or created, for pages that didn't exist), so that they are tried again
+def revalidateNegativeCache():
+    titles = list(negativeCache)
+    headers = {"User-Agent": "My-Bot-Name/1.0"}
+    for start in range(0, len(titles), 50):
+        params = {
+            "action": "query",
+            "prop": "revisions",
+            "titles": "|".join(titles[start:start + 50]),
+            "rvprop": "ids",
+            "format": "json",
+            "formatversion": "2",
+        }
+        req = requests.get(API_URL, headers=headers, params=params)
+        for page in req.json()["query"]["pages"]:
+            if "revisions" in page:
+                noteRevision(page["title"], page["revisions"][0]["revid"])
+            if page["title"] in negativeCache and negativeCache[page["title"]]["revision"] != recentRevisions.get(page["title"]):
+                print(f"{page['title']} has changed since it failed, so it will be tried again")
+                clearFailure(page["title"])
+
+
 # Takes in a page name and returns a parsed version of the page's contents
 def parse(title):
+    return mw.parse(fetchText(title))
+
+
+# Takes in a page name and returns the wikitext of the page
+def fetchText(title):
     params = {
         "action": "query",
         "prop": "revisions",
-        "rvprop": "content",
+        "rvprop": "content|ids",
         "rvslots": "main",
         "rvlimit": 1,
         "titles": title,
@@ -152,66 +957,39 @@ def parse(title):
     req = requests.get(API_URL, headers=headers, params=params)
     res = req.json()
     revision = res["query"]["pages"][0]["revisions"][0]
-    text = revision["slots"]["main"]["content"]
-    return mw.parse(text)
+    noteRevision(title, revision["revid"])
+    return revision["slots"]["main"]["content"]
+
+
+# Returns the pool of processes used to parse pages, starting it the first time it's needed, or None if 'parseWorkers' is 0
+def getParsePool():
+    global parsePool
+    if parsePool is None and parseWorkers > 0:
+        parsePool = ProcessPoolExecutor(max_workers=parseWorkers)
+    return parsePool
+
+
+# Starts reading a batch of (title, text) pairs into records with extractRecord, split between the parsing processes.
+# Returns a function that waits for the records and returns them in the same order.
+def startExtracting(pages):
+    pool = getParsePool()
+    if pool is None or len(pages) == 0:
+        return lambda: extractRecords(pages)
+    size = -(-len(pages) // parseWorkers)  # Ceiling division, so there's one chunk per worker
+    futures = [pool.submit(extractRecords, pages[var:var + size]) for var in range(0, len(pages), size)]
+    return lambda: [record for future in futures for record in future.result()]
 
 
 # Returns the value of a specified parameter for a specified page
 def getTaxonData(pageName, data):
     pageName = addTemplate(pageName)
-
-    page = parse(pageName)
-    temps = page.filter_templates()
-    for t in temps:
-        if t.has(data):
-            param = t.get(data)
-            paramData = param.split("=")[1]
-            return paramData
+    return taxonDataFromPage(parse(pageName), data)
 
 
 # Returns the value of the 'extinct' parameter for a specified page
 def getExtinct(pageName):
     pageName = addTemplate(pageName)
-
-    page = parse(pageName)
-    temps = page.filter_templates()
-    temp = ""
-    found = False
-    for t in temps:
-        if t.has("extinct"):
-            temp = t
-            found = True
-            break
-    if found:
-        param = temp.get("extinct").lower()
-        paramData = cleanPageName(param.split("=")[1])
-    return found and (paramData == "yes" or paramData == "true")
-
-
-# Removes dumb characters from the pagename like spaces or newlines
-def cleanPageName(pageName):
-    pageName = pageName.replace("/?", "")
-    pageName = pageName.replace("?", "")
-    pageName = pageName.replace("/displayed", "")
-    pageName = pageName.replace("/skip", "")
-    pageName = pageName.replace("/Class", "")
-    pageName = pageName.replace("\r", "")
-    pageName = pageName.replace("/\"", "")
-    pageName = pageName.replace("_", " ")
-    pageName = re.sub("[Ii]ncertae [sc]edis/", "", pageName) # Different spellings of Incertae sedis
-    pageName = re.sub("<.*>", "", pageName)  # Removes HTML comments as well as HTML tags
-    pageName = re.sub("<.*", "", pageName)  # In case splitting splits on an = inside the tags
-    pageName = pageName.strip()
-    return pageName
-
-
-# Removes dumb characters from the rank, then anglicises it
-def cleanRank(rank):
-    rank = rank.strip()
-    rank = re.sub("<!--.*-->", "", rank)
-    for rep in replacements:
-        rank = rank.replace(rep, replacements[rep])
-    return rank
+    return extinctFromPage(parse(pageName))
 
 
 # Turns a 'name' into a 'Template:Taxonomy/name' and does nothing otherwise
@@ -234,8 +1012,12 @@ def parseAndRedirect(pageName):
 
 # Registers a common name for a given taxon
 def registerCommonName(taxon, common):
-    commonNames[common] = taxon
-    treeDict[taxon].setCommonName(common)
+    with treeLock.writing():
+        node = treeDict[taxon]
+        oldName = node.commonName if hasattr(node, "commonName") else ""
+        commonNames[common] = taxon
+        node.setCommonName(common)
+        notifyChange("commonName", taxon, oldName)
 
 
 # Removes a common name from a given taxon
@@ -245,8 +1027,10 @@ def removeCommonName(taxon):
     if commonName == "":
         print(f"No common name exists for {taxon}")
     else:
-        node.removeCommonName()
-        commonNames.pop(commonName)
+        with treeLock.writing():
+            node.removeCommonName()
+            commonNames.pop(commonName)
+            notifyChange("commonName", taxon, commonName)
         print(f"Removed the common name '{commonName}' for {taxon}")
 
 
@@ -262,8 +1046,17 @@ def searchCommonNames(taxon, children=False):
         if hasattr(clade, "commonName") and clade.commonName != "":
             print(f"Common name '{clade.commonName}' already exists for {name}")
             continue
+        # Failures are recorded against the page that was being read, so the cache can tell when that page is edited
+        title = addTemplate(name)
+        if isNegativeCached(title):
+            print(f"Skipping {name}, as {title} failed before: {negativeCache[title]['reason']}")
+            continue
         try:
             link = cleanPageName(getTaxonData(name, "link"))
+            title = link
+            if isNegativeCached(link):
+                print(f"Skipping {name}, as {link} failed before: {negativeCache[link]['reason']}")
+                continue
             if link != name:
                 ccn = checkCommonName(link)
                 if ccn:
@@ -285,9 +1078,30 @@ def searchCommonNames(taxon, children=False):
                     else:
                         print(f"No common name found for {name}")
         except KeyError:
+            recordFailure(title, "KeyError when searching for a common name")
             continue
 
 
+# Prints every taxon with a common name containing the given words, optionally only those below a given clade
+# With 'prefix', the last word only has to be the start of a word, e.g. "tree fr" finds tree frogs
+def findCommonNames(text, prefix=False, under=""):
+    for taxon, commonName in commonNameIndex.search(text, prefix, under):
+        print(f"{commonName} ({taxon})")
+
+
+# Returns the nodes below a given clade that have no common name yet, optionally only those of a given rank
+def missingCommonNames(clade, rank=""):
+    output = []
+    stack = list(reversed(treeChildren.childrenOf(clade)))
+    while stack:
+        name = stack.pop()
+        node = treeDict[name]
+        if (rank == "" or node.rank == rank) and getattr(node, "commonName", "") == "":
+            output.append(name)
+        stack.extend(reversed(treeChildren.childrenOf(name)))
+    return output
+
+
 # Checks if the given string is a common name for a taxon (e.g. Spider for Aranea)
 # Guarantees that the true taxon will be in the tree, if it exists
 def checkCommonName(pageName):
@@ -356,16 +1170,23 @@ def getTaxonFromCommonName(commonName):
 
 
 # Attempts to parse 'Template:Taxonomy/<pageName>' as a Wikipedia page and returns whether it succeeds or not
+# Known failures are returned straight away from the negative cache, and new ones are added to it
 def checkTaxonomyTemplate(pageName):
     pageName = cleanPageName(pageName)
     found = False
+    tempPageName = addTemplate(pageName)
+    if isNegativeCached(tempPageName):
+        return False
     try:
-        tempPageName = addTemplate(pageName)
         content = parse(tempPageName)
-        if "#redirect" not in content.lower() and "category:unnecessary taxonomy templates" not in content.lower():
+        if "#redirect" in content.lower():
+            recordFailure(tempPageName, "Taxonomy template is a redirect")
+        elif "category:unnecessary taxonomy templates" in content.lower():
+            recordFailure(tempPageName, "Unnecessary taxonomy template")
+        else:
             found = True
     except KeyError:
-        pass
+        recordFailure(tempPageName, "Taxonomy template does not exist")
     return found
 
 
@@ -391,30 +1212,12 @@ def checkSpecies(pageName):
 def getSpeciesTaxon(species):
     pageName = cleanPageName(species)
     page = parseAndRedirect(pageName)
-    temps = page.filter_templates()
-    for t in temps:
-        name = cleanPageName(str(t.name))
-        if name.lower() == "speciesbox":  # TODO: Check for speciesboxes with the subgenus parameter
-            if t.has("taxon"):
-                param = t.get("taxon")
-                paramData = cleanPageName(param.split("=")[1])
-                genus = paramData.split()[0]
-                species = paramData.split()[1]
-            else:
-                param1 = t.get("genus")
-                param2 = t.get("species")
-                genus = cleanPageName(param1.split("=")[1])
-                species = cleanPageName(param2.split("=")[1])
+    found = speciesFromPage(page)
+    if found is not None:
+        genus, species, subspecies, extinct = found
+        if subspecies == "":
             return genus, species
-        elif name.lower() == "subspeciesbox":
-            # Wikipedia says subspeciesbox requires the taxon in parts
-            param1 = t.get("genus")
-            param2 = t.get("species")
-            param3 = t.get("subspecies")
-            genus = cleanPageName(param1.split("=")[1])
-            species = cleanPageName(param2.split("=")[1])
-            subspecies = cleanPageName(param3.split("=")[1])
-            return genus, species, subspecies
+        return genus, species, subspecies
 
 
 # Gets whether a given species/subspecies is extinct or not
@@ -431,14 +1234,16 @@ def getSpeciesExtinct(clade):
 
 
 # Prints out a taxon tree
-def printTaxonTree(pageName, mainRanksOnly=False):
-    clades = listTaxonTree(pageName).copy()
+# With 'fuzzy' (the default), a misspelling of a name in the tree is reported straight away, see listTaxonTree
+def printTaxonTree(pageName, mainRanksOnly=False, fuzzy=True):
+    clades = listTaxonTree(pageName, fuzzy).copy()
+    if mainRanksOnly and clades[0] in treeDict:
+        clades = [clades[0]] + mainRanksView.lineage(clades[0])
     clades.reverse()
-    mainRanks = ["kingdom", "phylum", "class", "order", "family", "genus", "species"]
     for clade in clades:
         if clade in treeDict:
             node = treeDict[clade]
-            if (not mainRanksOnly) or (node.rank in mainRanks) or (clade == pageName):
+            if (not mainRanksOnly) or (node.rank in mainRanks) or (clade == clades[-1]):
                 print(node.rank + " - " + clade)
         elif treeDict[clade.split()[0]].rank == "genus":
             taxonArray = clade.split()
@@ -448,8 +1253,70 @@ def printTaxonTree(pageName, mainRanksOnly=False):
                 print("subspecies - " + clade)
 
 
+# Raised when a name isn't a taxon, alias or common name, either in the tree or on Wikipedia.
+# 'suggestions' holds (name, taxon, score) tuples for the closest names in the tree, from FuzzyIndex.suggest.
+class TaxonNotFoundError(KeyError):
+    def __init__(self, name, suggestions, reason=""):
+        super().__init__(name)
+        self.name = name
+        self.suggestions = suggestions
+        self.reason = reason
+
+    def __str__(self):
+        message = f"{self.name} is not a valid taxon or common name."
+        if self.reason != "":
+            message += f" ({self.reason})"
+        if len(self.suggestions) > 0:
+            message += " Did you mean " + ", ".join(suggestion[0] for suggestion in self.suggestions) + "?"
+        return message
+
+
+# Endings that give the rank of a taxon, e.g. -idae for families and -inae for subfamilies, longest first so -oideae
+# isn't taken for -eae. Names that only differ in these are different taxa, like Noasauridae and Noasaurinae.
+rankSuffixes = ["iformes", "oideae", "oidea", "morpha", "aceae", "idae", "inae", "ales", "eae", "ini", "ina"]
+
+
+def rankSuffix(name):
+    name = name.lower()
+    for suffix in rankSuffixes:
+        if name.endswith(suffix):
+            return suffix
+    return ""
+
+
+# Returns the edit distance between two names, ignoring case, with swapping two letters next to each other as one edit
+def editDistance(first, second):
+    first = first.lower()
+    second = second.lower()
+    before = None
+    previous = list(range(len(second) + 1))
+    for i in range(1, len(first) + 1):
+        current = [i]
+        for j in range(1, len(second) + 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (first[i - 1] != second[j - 1])))
+            if i > 1 and j > 1 and first[i - 1] == second[j - 2] and first[i - 2] == second[j - 1]:
+                current[j] = min(current[j], before[j - 2] + 1)
+        before, previous = previous, current
+    return previous[-1]
+
+
+# Returns whether a name is so close to one in the tree that it must be a misspelling of it, rather than another taxon.
+# Taxon names are packed closely together (Corvus and Cervus, Plesiosaurus and Pliosaurus), so this only allows one edit,
+# or two in names of 12 letters or more, and never a different first or last letter or rank ending, as those usually
+# make another real name (Eureptilia and Reptilia, Pistosaurus and Pistosauria, Noasauridae and Noasaurinae).
+def isMisspelling(name, match):
+    if name[:1].lower() != match[:1].lower() or name[-1:].lower() != match[-1:].lower():
+        return False
+    if rankSuffix(name) != rankSuffix(match):
+        return False
+    return editDistance(name, match) <= (2 if len(name) >= 12 else 1)
+
+
 # Returns the list form of a taxon tree
-def listTaxonTree(pageName):
+# Raises TaxonNotFoundError if the name can't be found. With 'fuzzy', which is for names typed in by people, a name that
+# looks like a misspelling of one in the tree (see isMisspelling) gives the error straight away instead of searching
+# Wikipedia for it. Anything else is looked up as usual, and only gets suggestions if that fails.
+def listTaxonTree(pageName, fuzzy=False):
     pageName = cleanPageName(pageName)
     if pageName in treeDict:
         return treeDict[pageName].cladeList
@@ -457,11 +1324,24 @@ def listTaxonTree(pageName):
         return treeDict[aliases[pageName]].cladeList
     elif pageName in commonNames:
         return treeDict[commonNames[pageName]].cladeList
+
+    suggestions = None
+    if fuzzy:
+        suggestions = fuzzyIndex.suggest(pageName)
+        if any(isMisspelling(pageName, name) for name, taxon, score in suggestions):
+            raise TaxonNotFoundError(pageName, suggestions, "Not in the tree")
+    if isNegativeCached(pageName):
+        raise TaxonNotFoundError(pageName, suggestions if suggestions is not None else fuzzyIndex.suggest(pageName),
+                                 negativeCache[pageName]["reason"])
     elif checkTaxonomyTemplate(pageName):
         addTaxonTree(pageName)
         return listTaxonTree(pageName)
     elif checkSpecies(pageName) == 1:
-        genus, species = getSpeciesTaxon(pageName)
+        try:
+            genus, species = getSpeciesTaxon(pageName)
+        except KeyError:
+            recordFailure(pageName, "KeyError when reading the speciesbox")
+            raise
         addSpecies(genus, species)
         clade = genus + " " + species
         if pageName != clade:
@@ -479,19 +1359,25 @@ def listTaxonTree(pageName):
         registerCommonName(taxon, pageName)
         return treeDict[commonNames[pageName]].cladeList
     else:
-        print(f"{pageName} is not a valid taxon or common name.")
-        sys.exit()
+        recordFailure(pageName, "Not a taxonomy template, species or common name")
+        raise TaxonNotFoundError(pageName, suggestions if suggestions is not None else fuzzyIndex.suggest(pageName))
 
 
 # Adds a new taxon tree to the dictionary
-def addTaxonTree(pageName):
+# The taxonomy template is only downloaded if it hasn't already been read and passed in as 'record', from extractRecord
+def addTaxonTree(pageName, record=None):
     pageName = cleanPageName(pageName)
-    parent = cleanPageName(getTaxonData(pageName, "parent"))
-    rank = cleanRank(getTaxonData(pageName, "rank"))
-    extinct = getExtinct(pageName)
-    result = [pageName] + listTaxonTree(parent)
-    treeDict[pageName] = Node(pageName, result, rank, extinct)
-    registerChild(pageName)
+    if record is None:
+        record = extractRecord(addTemplate(pageName), fetchText(addTemplate(pageName)))
+    if record["parent"] is None or record["rank"] is None:
+        raise KeyError(f"{pageName} has no parent or rank: {record['error']}")
+    rank = record["rank"]
+    extinct = record["extinct"]
+    result = [pageName] + listTaxonTree(record["parent"])
+    with treeLock.writing():
+        treeDict[pageName] = Node(pageName, result, rank, extinct)
+        registerChild(pageName)
+        notifyChange("added", pageName)
 
 
 # Specialised function for adding species or subspecies to the tree, as they do not use Template:Taxobox
@@ -512,17 +1398,91 @@ def addSpecies(genus, species, subspecies=""):
     else:
         result = [clade] + listTaxonTree(genus + " " + species)
         rank = "subspecies"
-    treeDict[clade] = Node(clade, result, rank, extinct)
-    registerChild(clade)
+    with treeLock.writing():
+        treeDict[clade] = Node(clade, result, rank, extinct)
+        registerChild(clade)
+        notifyChange("added", clade)
+
+
+# Adds every species and subspecies with an article under the given taxon in one go.
+# The articles are found through what transcludes the taxon's taxonomy template, or through a category if one is given,
+# and are downloaded 50 at a time. Nothing is added to the tree until every page has been read.
+# As with addSpecies, everything under an extinct genus is extinct. Returns how many nodes were added.
+def addAllSpecies(taxon, category=""):
+    taxon = cleanPageName(taxon)
+    if taxon in aliases:
+        taxon = aliases[taxon]
+    if category == "":
+        params = {"generator": "embeddedin", "geititle": addTemplate(taxon), "geinamespace": 0, "geilimit": 50}
+    else:
+        params = {"generator": "categorymembers", "gcmtitle": "Category:" + category, "gcmnamespace": 0, "gcmlimit": 50}
+
+    found = {}
+    for title, record, cont in queryPages(params):
+        if record["error"] is not None:
+            print(f"Error when reading {title}")
+            continue
+        result = record["species"]
+        if result is None:
+            continue
+        genus, species, subspecies, extinct = result
+        if genus not in treeDict or not isUnder(genus, taxon):
+            print(f"Skipping {title}, as {genus} is not in the tree under {taxon}")
+            continue
+        clade = (genus + " " + species + " " + subspecies).strip()
+        if clade not in treeDict and clade not in found:
+            found[clade] = (title, genus, species, subspecies, extinct)
+
+    # Species are made before subspecies, so that every subspecies has a species to go under
+    newNodes = {}
+    for clade in sorted(found, key=lambda name: name.count(" ")):
+        title, genus, species, subspecies, extinct = found[clade]
+        genusNode = treeDict[genus]
+        genusExtinct = getattr(genusNode, "extinct", False)
+        if subspecies == "":
+            parentList = genusNode.cladeList
+            rank = "species"
+        else:
+            speciesName = genus + " " + species
+            if speciesName not in treeDict and speciesName not in newNodes:
+                newNodes[speciesName] = Node(speciesName, [speciesName] + genusNode.cladeList, "species", genusExtinct)
+            speciesNode = treeDict[speciesName] if speciesName in treeDict else newNodes[speciesName]
+            parentList = speciesNode.cladeList
+            rank = "subspecies"
+        newNodes[clade] = Node(clade, [clade] + parentList, rank, genusExtinct or extinct)
+
+    with treeLock.writing():
+        for clade in newNodes:
+            treeDict[clade] = newNodes[clade]
+            registerChild(clade)
+            notifyChange("added", clade)
+            if clade in found and found[clade][0] != clade:
+                registerCommonName(clade, found[clade][0])
+    print(f"Added {str(len(newNodes))} species and subspecies under {taxon}")
+    return len(newNodes)
+
+
+# Returns the nearest ancestor of a taxon with the given rank, e.g. rankAncestor("Crocodylus", "family")
+def rankAncestor(taxon, rank):
+    taxon = cleanPageName(taxon)
+    if taxon not in treeDict:
+        taxon = listTaxonTree(taxon)[0]
+    return rankAncestorIndex.ancestor(taxon, rank)
+
+
+# Groups a list of taxa by their family, order or any other rank in 'ancestorRanks', for classification exports
+def groupByRank(taxa, rank="family"):
+    return rankAncestorIndex.group(taxa, rank)
 
 
 # The main function of my original system, this takes two clade names and finds the deepest clade that is common to both
-def commonClade(page1, page2):
+# 'fuzzy' is passed on to listTaxonTree
+def commonClade(page1, page2, fuzzy=True):
     print("Generating list 1")
-    list1 = listTaxonTree(page1).copy()
+    list1 = listTaxonTree(page1, fuzzy).copy()
     list1.reverse()
     print("Generating list 2")
-    list2 = listTaxonTree(page2).copy()
+    list2 = listTaxonTree(page2, fuzzy).copy()
     list2.reverse()
     print("Comparing lists")
     st = ""
@@ -576,7 +1536,7 @@ def backlinks(page, limit, cont="", subpageOnly=True):
         contOut = res['continue']['blcontinue']
     for var in text:
         spl = var['title'].split("/")
-        if spl[0] == "Template:Taxonomy" and spl[1] != "Incertae sedis" and spl[1] not in dumbStuff:
+        if spl[0] == "Template:Taxonomy" and spl[1] != "Incertae sedis" and not isNegativeCached(var['title']):
             if subpageOnly:
                 output.append(spl[1])
             else:
@@ -584,38 +1544,144 @@ def backlinks(page, limit, cont="", subpageOnly=True):
     return output, contOut
 
 
+# Runs a query with a generator, yielding (title, record, continuation) for every page it generates, where the record
+# is what extractRecord reads from the page.
+# Each page's content comes back in the same request as the list of pages, 50 at a time. The next batch is requested
+# in the background while the current one is parsed by the pool of parsing processes, so only the records are dealt with here.
+# The continuation is that of the batch the page came from, so passing it back in as 'cont' starts again from that batch.
+def queryPages(generatorParams, cont=None):
+    params = {
+        "action": "query",
+        "prop": "revisions",
+        "rvprop": "content|ids",
+        "rvslots": "main",
+        "format": "json",
+        "formatversion": "2",
+    }
+    params.update(generatorParams)
+    headers = {"User-Agent": "My-Bot-Name/1.0"}
+
+    def fetch(batchCont):
+        req = requests.get(API_URL, headers=headers, params={**params, **batchCont})
+        return req.json()
+
+    current = cont if cont is not None else {}
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(fetch, current)
+        while future is not None:
+            res = future.result()
+            if "continue" in res:
+                nextCont = res["continue"]
+                future = executor.submit(fetch, nextCont)
+            else:
+                nextCont = None
+                future = None
+            # Pages whose content didn't fit in this response come back again with it in a later one
+            pages = []
+            for var in res.get("query", {}).get("pages", []):
+                if "revisions" in var:
+                    noteRevision(var["title"], var["revisions"][0]["revid"])
+                    pages.append((var["title"], var["revisions"][0]["slots"]["main"]["content"]))
+            for record in startExtracting(pages)():
+                yield record["title"], record, current
+            current = nextCont
+
+
+# Yields (subpage, record, continuation) for every taxonomy template linking to the given page, using queryPages
+def backlinkPages(page, cont=None):
+    params = {
+        "generator": "backlinks",
+        "gbltitle": page,
+        "gblnamespace": 10,
+        "gbllimit": 50,
+        "gblfilterredir": "nonredirects",
+    }
+    for title, record, pageCont in queryPages(params, cont):
+        spl = title.split("/", 1)
+        if spl[0] == "Template:Taxonomy" and len(spl) == 2 and spl[1] != "Incertae sedis" and not isNegativeCached(title):
+            yield spl[1], record, pageCont
+
+
+# Downloads and reads the taxonomy templates of up to 50 nodes in one request, returning a dictionary of each node's record
+# Nodes whose template couldn't be downloaded are left out, so refreshData downloads them itself
+def fetchRecords(names):
+    titles = "|".join(addTemplate(name) for name in names)
+    return {title.split("/", 1)[1]: record for title, record, cont in queryPages({"titles": titles})}
+
+
 # Adds the given page, as well as every clade below it, to the tree
 def addAll(page):
-    pages, cont = backlinks("Template:Taxonomy/" + page, 500)
+    crawl([page])
+
+
+# Adds every clade below each of the given pages to the tree.
+# Templates are downloaded along with their backlinks and the crawl is recorded in a frontier on disk, so memory use
+# doesn't grow with the size of the crawl and a template reachable from several roots or /skip templates is only visited once.
+# Checkpoints are taken every 'checkpointInterval' added templates, and the frontier is only committed straight after one
+# (or when nothing has been added since the last), so it never gets ahead of the saved tree and an interrupted crawl
+# carries on where it stopped.
+def crawl(roots, frontierFile=FRONTIER_FILE):
+    frontier = Frontier(frontierFile)
+    if not frontier.finished():
+        print(f"Resuming the crawl in {frontierFile}")
+    for root in roots:
+        frontier.addRoot(root)
+    frontier.commit()
+
     counter = 1
     while True:
-        for var in pages:
-            if "/skip" in var:
-                cleanVar = cleanPageName(var)
-                if cleanVar == page:
-                    continue
-                if cleanVar in treeDict and treeDict[cleanVar].skip:
-                    print(f"Found completed /skip. Skipping item {str(counter)}: {cleanVar}")
-                else:
-                    print(f"Found incomplete /skip. Now running addAll({cleanVar}).")
-                    addAll(cleanVar)
-                    treeDict[cleanVar].flagSkip()
-                    print(f"Added all subpages for item {str(counter)}: {var}")
+        nextRoot = frontier.nextRoot()
+        if nextRoot is None:
+            break
+        root, cont = nextRoot
+        batchCont = json.loads(cont) if cont != "" else {}
+        added = False
+        for subpage, record, pageCont in backlinkPages("Template:Taxonomy/" + root, batchCont):
+            if pageCont != batchCont:
+                # A new batch has started, so everything from the last one has been dealt with
+                batchCont = pageCont
+                frontier.setCursor(root, json.dumps(batchCont))
+                if not added:
+                    frontier.commit()
+
+            if "/skip" in subpage:
+                cleanVar = cleanPageName(subpage)
+                if cleanVar != cleanPageName(root) and frontier.addRoot(cleanVar):
+                    print(f"Found /skip. Now crawling {cleanVar} as well.")
+                frontier.addRoot(subpage)
+                continue
+
+            var = cleanPageName(subpage)
+            if not frontier.visit(var, root):
+                continue
+            if var not in treeDict and var not in aliases:
+                # Variants like Incertae sedis/X or X/? can give a different parent to X's own template, so the record that
+                # came with the backlink is only used if it is X's own template, and addTaxonTree downloads it otherwise
+                if addTemplate(var) != "Template:Taxonomy/" + subpage:
+                    record = None
+                try:
+                    addTaxonTree(var, record)
+                    clearFailure("Template:Taxonomy/" + subpage)
+                    print(f"Added item {str(counter)}: {var}")
+                    added = True  # Since the last checkpoint
+                    if tickCheckpoint():
+                        frontier.commit()
+                        added = False
+                except KeyError:
+                    recordFailure("Template:Taxonomy/" + subpage, "KeyError when adding")
+                    print(f"Error when adding {var}")
             else:
-                if var not in treeDict and var not in aliases:
-                    try:
-                        addTaxonTree(var)
-                        print(f"Added item {str(counter)}: {var}")
-                    except KeyError:
-                        print(f"Error when adding {var}")
-                else:
-                    print(f"Item {str(counter)} already exists: {var}")
+                print(f"Item {str(counter)} already exists: {var}")
             counter += 1
 
-        if cont == -1:
-            break
-        else:
-            pages, cont = backlinks("Template:Taxonomy/" + page, 500, cont=cont)
+        frontier.setCursor(root, -1)
+        if added:
+            checkpoint()
+        frontier.commit()
+
+    print(f"Crawl finished. Visited {str(frontier.visited())} templates.")
+    frontier.reset()
+    frontier.close()
 
 
 # Deletes a node from the tree. Nodes with children cannot be deleted, for safety's sake.
@@ -627,8 +1693,11 @@ def delNode(node):
         print("Node has children, cannot delete.")
         return
     else:
-        treeDict[treeDict[node].parent].removeChild(node)
-        del treeDict[node]
+        with treeLock.writing():
+            parent = treeDict[node].parent
+            treeDict[parent].removeChild(node)
+            del treeDict[node]
+            notifyChange("removed", node, parent)
         print("Node deleted")
 
 
@@ -655,50 +1724,37 @@ def registerChild(node):
 # Returns a list of the children of a given node
 def childrenOf(node, noGen=False):
     if noGen:
-        outputList = []
-        for var in treeDict[node].children:
-            if treeDict[var].rank != "genus":
-                outputList.append(var)
-        return outputList
+        return list(subtreeIndex.childrenWithoutGenera(node))
     else:
-        return treeDict[node].children
+        return list(treeChildren.childrenOf(node))
 
 
 # Returns a list of all other nodes who are children of this node's parent
 # The optional 'noGen' parameter can be used to only print out clades and exclude all genera
 def sisterClades(clade, noGen=False):
-    tempList = treeDict[treeDict[clade].parent].children.copy()
-    tempList.remove(clade)
-    if noGen:
-        outputList = []
-        for var in tempList:
-            if treeDict[var].rank != "genus":
-                outputList.append(var)
-        return outputList
-    else:
-        return tempList
+    parent = treeDict[clade].parent
+    tempList = subtreeIndex.childrenWithoutGenera(parent) if noGen else treeChildren.childrenOf(parent)
+    return [var for var in tempList if var != clade]
 
 
 # Returns a count of how many genera are currently listed under the given clade
-def countGenera(clade, counter=0):
-    for var in treeDict[clade].children:
-        if "genus" in treeDict[var].rank:
-            counter += 1
-        else:
-            counter = countGenera(var, counter)
-    return counter
+def countGenera(clade):
+    return subtreeIndex.countGenusLike(clade)
 
 
 # Returns a list of all genera currently listed under the given clade
-def listGenera(clade, currentList=None):
-    if currentList is None:
-        currentList = []
-    for var in treeDict[clade].children:
-        if treeDict[var].rank == "genus":
-            currentList.append(var)
-        else:
-            currentList = listGenera(var, currentList)
-    return currentList
+def listGenera(clade):
+    return subtreeIndex.genera(clade)
+
+
+# Returns a list of every node of the given rank under the given clade, e.g. listUnder("Crocodylidae", "species")
+def listUnder(clade, rank):
+    return subtreeIndex.listUnder(clade, rank)
+
+
+# Returns whether a taxon is the given clade or somewhere below it
+def isUnder(taxon, clade):
+    return subtreeIndex.isUnder(taxon, clade)
 
 
 # Forces the system to re-get the data for a given clade
@@ -714,32 +1770,148 @@ def forceUpdate(clade):
 
 
 # Refreshes the data of a given node
-def refreshData(name, allData=False):
+# The taxonomy template is only downloaded if it hasn't already been read and passed in as 'record', from extractRecord
+def refreshData(name, allData=False, record=None):
     name = name.replace("Template:Taxonomy/", "")
     node = treeDict[name]
     if allData:
         try:
-            newParent = cleanPageName(getTaxonData(name, "parent"))
-            newRank = cleanRank(getTaxonData(name, "rank"))
-            newExtinct = getExtinct(name)
-
-            if newParent != node.parent:
-                if newParent in aliases:
-                    newParent = aliases[newParent]
-                elif newParent not in treeDict:
-                    addTaxonTree(newParent)
-                treeDict[node.parent].removeChild(name)
-                node.setParent(newParent)
-                registerChild(name)
-
-            node.setRank(newRank)
-            node.setExtinct(newExtinct)
-
-            node.markUpdated()
+            if record is None:
+                record = extractRecord(addTemplate(name), fetchText(addTemplate(name)))
+            if record["parent"] is None or record["rank"] is None:
+                raise KeyError(f"{name} has no parent or rank")
+            newParent = record["parent"]
+            newRank = record["rank"]
+            newExtinct = record["extinct"]
+
+            if newParent in aliases:
+                newParent = aliases[newParent]
+            elif newParent not in treeDict:
+                addTaxonTree(newParent)
+
+            with treeLock.writing():
+                # This also puts back nodes whose parent went missing or lost track of them
+                if newParent != node.parent or name not in treeDict[newParent].children:
+                    oldParent = node.parent
+                    if oldParent in treeDict:
+                        treeDict[oldParent].removeChild(name)
+                    node.setParent(newParent)
+                    registerChild(name)
+                    if newParent != oldParent:
+                        notifyChange("moved", name, oldParent)
+
+                oldRank = node.rank
+                oldExtinct = getattr(node, "extinct", False)
+                node.setRank(newRank)
+                node.setExtinct(newExtinct)
+                if newRank != oldRank:
+                    notifyChange("rank", name, oldRank)
+                if newExtinct != oldExtinct:
+                    notifyChange("extinct", name, oldExtinct)
+
+                node.markUpdated()
         except (AttributeError, KeyError):
             print(f"Error when updating {name}")
 
-    node.setCladeList([name] + listTaxonTree(node.parent))
+    cladeList = [name] + listTaxonTree(node.parent)
+    with treeLock.writing():
+        node.setCladeList(cladeList)
+
+
+# Checks every node in one pass for problems left behind by updates and deletions, returning a dictionary of problems by
+# type and a list of the nodes that can only be fixed by downloading them again. The types are:
+#   missingChild - a node that isn't in its parent's list of children
+#   wrongChild - a node in a list of children that doesn't exist or has a different parent
+#   duplicateChild - a node listed more than once in its parent's list of children
+#   staleCladeList - a node whose cladeList doesn't match its parent's
+#   deadCommonName - a common name for a node that doesn't exist
+#   unregisteredCommonName - a node whose common name isn't in commonNames
+#   orphan - a node whose parent doesn't exist
+#   unreachable - a node in a loop of parents, so it isn't under any root
+# With 'repair', everything that can be fixed without downloading anything is fixed.
+def checkTree(repair=False):
+    problems = {"missingChild": [], "wrongChild": [], "duplicateChild": [], "staleCladeList": [],
+                "deadCommonName": [], "unregisteredCommonName": [], "orphan": [], "unreachable": []}
+    refetch = []
+    lock = treeLock.writing() if repair else treeLock.reading()
+    with lock:
+        children = childrenByParent(treeDict)
+        for name, node in treeDict.items():
+            if node.parent in treeDict:
+                if name not in treeDict[node.parent].children:
+                    problems["missingChild"].append(name)
+                    if repair:
+                        treeDict[node.parent].addChild(name)
+            elif node.parent != "":
+                problems["orphan"].append(name)
+                refetch.append(name)
+
+            seen = set()
+            for child in node.children[:]:
+                if child not in treeDict or treeDict[child].parent != name:
+                    problems["wrongChild"].append((name, child))
+                    if repair:
+                        node.removeChild(child)
+                elif child in seen:
+                    problems["duplicateChild"].append((name, child))
+                    if repair:
+                        node.removeChild(child)
+                seen.add(child)
+
+            commonName = getattr(node, "commonName", "")
+            if commonName != "" and commonNames.get(commonName) != name:
+                problems["unregisteredCommonName"].append(name)
+                if repair and commonNames.get(commonName) not in treeDict:
+                    commonNames[commonName] = name
+
+        for commonName, taxon in list(commonNames.items()):
+            if taxon not in treeDict:
+                problems["deadCommonName"].append(commonName)
+                if repair:
+                    commonNames.pop(commonName)
+
+        # Every cladeList is worked out from the top down, going by the nodes' parents, so a stale one is found
+        # along with everything below it even when nothing is being repaired
+        reached = 0
+        stack = [(name, node.cladeList) for name, node in treeDict.items() if node.parent not in treeDict]
+        while stack:
+            name, expected = stack.pop()
+            reached += 1
+            node = treeDict[name]
+            if node.cladeList != expected:
+                problems["staleCladeList"].append(name)
+                if repair:
+                    node.setCladeList(expected)
+            stack.extend((child, [child] + expected) for child in children.get(name, []))
+        if reached < len(treeDict):
+            reachable = set()
+            stack = [name for name in treeDict if treeDict[name].parent not in treeDict]
+            while stack:
+                name = stack.pop()
+                reachable.add(name)
+                stack.extend(children.get(name, []))
+            problems["unreachable"] = [name for name in treeDict if name not in reachable]
+            refetch += problems["unreachable"]
+
+        if repair and any(len(problems[problem]) > 0 for problem in problems):
+            # The indexes are rebuilt from scratch rather than being told about each fix
+            notifyChange("loaded", "")
+
+    for problem in problems:
+        if len(problems[problem]) > 0:
+            print(f"{problem}: {str(len(problems[problem]))}")
+    return problems, refetch
+
+
+# Fixes the tree using checkTree, downloading only the nodes that can't be fixed locally, rather than refreshing whole subtrees
+def repairTree():
+    problems, refetch = checkTree(repair=True)
+    for name in refetch:
+        if name in treeDict:
+            refreshData(name, True)
+            print(f"Updated {name}")
+    if len(refetch) > 0:
+        checkTree(repair=True)
 
 
 # Traverses the tree to refresh the data of all child nodes
@@ -812,7 +1984,7 @@ def checkListForUpdates(toCheck):
         "action": "query",
         "prop": "revisions",
         "titles": joinedList,
-        "rvprop": "timestamp",
+        "rvprop": "timestamp|ids",
         "format": "json",
         "formatversion": "2",
     }
@@ -827,62 +1999,135 @@ def checkListForUpdates(toCheck):
         names.append(name)
         try:
             revisions.append(id["revisions"][0]["timestamp"])
+            noteRevision(name, id["revisions"][0]["revid"])
         except KeyError:
             print(f"{name} has caused an error. The page likely does not exist.")
-            revisions.append(datetime.now().isoformat()[:-7] + "Z")  # A dummy date so the list is the correct size
+            recordFailure(name, "Taxonomy template does not exist")
+            revisions.append("")  # A dummy date so the list is the correct size, which is never newer than a node
 
     for var in range(len(names)):  # Needs to be names because the order isn't guaranteed to be the same as toCheck
-        name = names[var].split("/")[1]
+        name = names[var].split("/", 1)[1]
+        refreshScheduler.recordRevision(name, revisions[var])
+        refreshScheduler.recordCheck(name)
         if treeDict[name].lastUpdated < revisions[var]:
             output.append(name)
     return output
 
 
-# A long winded check for updates
-def fullUpdate(root="Vertebrata"):
-    # Step 1 - add any new pages that weren't caught
-    addAll(root)
-    # Step 1.5 - remember to check skip templates
-    addAll("Aves")  # remove once we get to Chordata
-    addAll("Aves/skip")  # remove once we get to Chordata
-    # addAll("Bombycina") (skips to Lepidoptera)
-
-    print("Looking for pages that need updating...")
-    # Step 2 - Get a list of pages that need updating
-    ary = []
-    needsUpdating = []
-    for var in treeDict:
-        if treeDict[var].rank != "species" and treeDict[var].rank != "subspecies":
-            ary.append("Template:Taxonomy/" + var)
-
-    length = len(ary)
-    iterations = (length // 50) + 1  # +1 to get the ceiling
-    iterCounter = 1
-    while len(ary) > 50:
-        print(f"Checking set {str(iterCounter)} of {str(iterations)}")
-        tempAry = []
-        for var in range(50):
-            tempAry.append(ary.pop(0))
-        needsUpdating += checkListForUpdates(tempAry)
-        iterCounter += 1
-    print(f"Checking set {str(iterations)} of {str(iterations)}")
-    needsUpdating += checkListForUpdates(ary)
-
-    if len(needsUpdating) > 0:
-        print("Updating pages...")
-        # Step 3 - Update everything that needs updating
-        for node in needsUpdating:
-            if node != "Life":
-                refreshData(node, True)
-                refreshChildren(node)
+# Checks the parts of the tree that are due a check, going by how often they get edited, using at most 'requestsPerDay'
+# requests a day. Running this regularly (e.g. daily) replaces fullUpdate for keeping the tree up to date, although it
+# doesn't look for new pages, so fullUpdate or addAll is still needed for those.
+# Checks and downloads of changed templates both come out of the scheduler's credit. Pages found out of date that there
+# isn't enough credit left to download are kept for the next run, and downloaded before anything else is checked.
+def scheduledUpdate(requestsPerDay=100):
+    refreshScheduler.earn(requestsPerDay)
+    with treeLock.reading():
+        needsUpdating = [name for name in dict.fromkeys(refreshScheduler.pending) if name in treeDict]
+        checks = int(refreshScheduler.credit) - -(-len(needsUpdating) // 50)  # Whatever isn't needed for the pending pages
+        due = [] if checks <= 0 else refreshScheduler.due(
+            treeDict, requestsPerDay, limit=checks * 50,
+            skip=lambda name: treeDict[name].rank in ["species", "subspecies"]
+            or isNegativeCached("Template:Taxonomy/" + name))
+    print(f"Checking {str(len(due))} pages")
+    for var in range(0, len(due), 50):
+        needsUpdating += [name for name in checkListForUpdates(["Template:Taxonomy/" + name for name in due[var:var + 50]])
+                          if name not in needsUpdating]
+        refreshScheduler.spend(1)
+
+    updated = 0
+    while updated < len(needsUpdating) and refreshScheduler.credit >= 1:
+        batch = needsUpdating[updated:updated + 50]
+        records = fetchRecords(batch)
+        refreshScheduler.spend(1)
+        for node in batch:
+            if node != "Life" and node in treeDict:
+                if node not in records:
+                    refreshScheduler.spend(1)  # refreshData downloads it by itself
+                refreshData(node, True, records.get(node))
                 print(f"Updated {node}")
+        updated += len(batch)
+    refreshScheduler.pending = needsUpdating[updated:]
+    if len(refreshScheduler.pending) > 0:
+        print(f"{str(len(refreshScheduler.pending))} pages are left to update in the next run")
+    if updated > 0:
+        checkTree(repair=True)
+    checkpoint()
+
+
+# A long winded check for updates, covering everything under the given roots
+# Progress is kept in crawlState["fullUpdate"], so calling this again after an interruption carries on from the same stage
+def fullUpdate(roots=None):
+    if roots is None:
+        roots = defaultRoots
+    state = crawlState["fullUpdate"]
+    if state is None or state["roots"] != list(roots):
+        state = {"roots": list(roots), "stage": "add", "toCheck": [], "needsUpdating": [], "position": 0}
+        crawlState["fullUpdate"] = state
     else:
-        print("Nothing to update.")
+        print(f"Resuming fullUpdate at the '{state['stage']}' stage")
+
+    if state["stage"] == "add":
+        # Step 1 - add any new pages that weren't caught, including those under skip templates
+        crawl(roots)
+        # The crawl's frontier has been reset, so the stage is moved on and saved straight away, or an interruption before
+        # the next checkpoint would crawl everything again
+        state["stage"] = "crawled"
+        checkpoint()
+
+    if state["stage"] == "crawled":
+        # Step 2 - Get a list of pages that need updating, leaving out any that are known to fail
+        revalidateNegativeCache()
+        state["toCheck"] = []
+        for var in treeDict:
+            if treeDict[var].rank != "species" and treeDict[var].rank != "subspecies":
+                if not isNegativeCached("Template:Taxonomy/" + var):
+                    state["toCheck"].append("Template:Taxonomy/" + var)
+        state["stage"] = "check"
+        state["position"] = 0
+        checkpoint()
+
+    if state["stage"] == "check":
+        print("Looking for pages that need updating...")
+        ary = state["toCheck"]
+        iterations = (len(ary) // 50) + 1  # +1 to get the ceiling
+        while state["position"] < len(ary):
+            print(f"Checking set {str(state['position'] // 50 + 1)} of {str(iterations)}")
+            state["needsUpdating"] += checkListForUpdates(ary[state["position"]:state["position"] + 50])
+            state["position"] += 50
+            tickCheckpoint()
+        state["stage"] = "update"
+        state["position"] = 0
+        checkpoint()
+
+    if state["stage"] == "update":
+        needsUpdating = state["needsUpdating"]
+        if len(needsUpdating) > 0:
+            print("Updating pages...")
+            # Step 3 - Update everything that needs updating
+            batchEnd = state["position"]
+            while state["position"] < len(needsUpdating):
+                node = needsUpdating[state["position"]]
+                if state["position"] >= batchEnd:
+                    batchEnd = state["position"] + 50
+                    records = fetchRecords(needsUpdating[state["position"]:batchEnd])
+                if node != "Life":
+                    refreshData(node, True, records.get(node))
+                    print(f"Updated {node}")
+                state["position"] += 1
+                tickCheckpoint()
+            # The cladeLists below anything that moved are fixed in one pass, instead of refreshing every subtree
+            checkTree(repair=True)
+        else:
+            print("Nothing to update.")
+
+    crawlState["fullUpdate"] = None
+    checkpoint()
 
 
 # Prints a line-by-line representation of a tree
+# With 'noExtinct', only the extant view of the tree is printed
 def printTreeReport(root, max=-1, depth=0, noExtinct=False):
-    if noExtinct and treeDict[root].extinct:
+    if noExtinct and not extantView.isKept(root):
         return
 
     indent = ""
@@ -895,52 +2140,99 @@ def printTreeReport(root, max=-1, depth=0, noExtinct=False):
         print(indent + root)
 
     if max == -1 or depth < max:
-        for var in clade.children:
+        children = extantView.childrenOf(root) if noExtinct else clade.children
+        for var in children:
             printTreeReport(var, max, depth + 1, noExtinct)
 
 
+# Predicates for fileTreeReport, each taking a node and returning whether it should be in the report
+def hasCommonName(node):
+    return getattr(node, "commonName", "") != ""
+
+
+def isExtant(node):
+    return not getattr(node, "extinct", False)
+
+
+# Returns a predicate for nodes with any of the given ranks, e.g. rankIn(["family", "genus"])
+def rankIn(ranks):
+    ranks = set(ranks)
+    return lambda node: node.rank in ranks
+
+
+# Returns a predicate for nodes updated after the given date, e.g. updatedAfter("2021-04-01")
+def updatedAfter(date):
+    return lambda node: getattr(node, "lastUpdated", "") > date
+
+
 # Creates a tree report in a file
-def fileTreeReport(root, max=-1, noExtinct=False):
-    if noExtinct and treeDict[root].extinct:
+# With 'noExtinct', only the extant view of the tree is written
+# With 'predicate', only the nodes it returns true for are written, along with the path to each of them from the root,
+# e.g. fileTreeReport("Animalia", predicate=hasCommonName) for tracking common names.
+# The report is made in a single depth first pass: each node's line is written out when the node is reached, then taken
+# back off when the node is finished if nothing in its subtree matched.
+def fileTreeReport(root, max=-1, noExtinct=False, predicate=None, fileName=None):
+    if noExtinct and not extantView.isKept(root):
         return
 
-    name = "Reports/" + root
-    if max != -1:
-        name += str(max)
-    if noExtinct:
-        name += " (Extant)"
-    name += ".txt"
-
-    stack = [(root, 0)]
-    with open(name, "w") as file:
+    if fileName is None:
+        fileName = "Reports/" + root
+        if max != -1:
+            fileName += str(max)
+        if noExtinct:
+            fileName += " (Extant)"
+        fileName += ".txt"
+
+    lines = []
+    matched = set()  # Nodes with a match somewhere in their subtree, including themselves
+    stack = [(root, 0, False, 0)]
+    with treeLock.reading():
         while stack:
-            node, depth = stack.pop(0)
-            indent = ""
-            for var in range(depth):
-                indent += "\t"
-
+            node, depth, finished, start = stack.pop()
             clade = treeDict[node]
-            if noExtinct and clade.extinct:
+            if finished:
+                if node in matched:
+                    matched.add(clade.parent)
+                else:
+                    del lines[start:]
                 continue
 
+            indent = "\t" * depth
             if hasattr(clade, "commonName") and clade.commonName != "":
-                file.write(indent + clade.commonName + " (" + node + ")\n")
+                lines.append(indent + clade.commonName + " (" + node + ")\n")
             else:
-                file.write(indent + node + "\n")
+                lines.append(indent + node + "\n")
 
+            if predicate is not None:
+                if predicate(clade):
+                    matched.add(node)
+                stack.append((node, depth, True, len(lines) - 1))
             if max == -1 or depth < max:
-                temp = []
-                for var in clade.children:
-                    temp.append((var, depth + 1))
-                stack[0:0] = temp
+                children = extantView.childrenOf(node) if noExtinct else clade.children
+                stack.extend((var, depth + 1, False, 0) for var in reversed(children))
+
+    with open(fileName, "w") as file:
+        file.writelines(lines)
+
+
+# Unpickles tree files, including old ones that were saved while this file was being run as __main__
+class TreeUnpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        if name == "Node":
+            return Node
+        return super().find_class(module, name)
+
+
+# Reads a saved tree (tree.txt or a backup) and returns its tuple without loading it
+def readTreeFile(fileName=TREE_FILE):
+    with open(fileName, "rb") as file:
+        return TreeUnpickler(file).load()
 
 
 # Goes through the default startup routine, importing the tree from the file and setting lastUpdated
 def importTree():
-    with open("tree.txt", "rb") as file:
-        # treeDict = pickle.load(file)
-        fileTuple = pickle.load(file)
-        loadData(fileTuple)
+    fileTuple = readTreeFile()
+    loadData(fileTuple)
 
 
 # DO NOT DELETE THIS CODE
@@ -956,13 +2248,7 @@ if __name__ == "__main__":
     #print(commonNames)
 
     """output = []
-    links, cont = backlinks("Template:Taxonomy/Nephrozoa",500,subpageOnly=False)
-    for var in links:
-        if "/skip" in var:
-            output.append(var)
-    while cont != -1:
-        links, cont = backlinks("Template:Taxonomy/Nephrozoa", 500, cont=cont, subpageOnly=False)
-        for var in links:
-            if "/skip" in var:
-                output.append(var)
-    print(output)"""
\ No newline at end of file
+    for subpage, page, cont in backlinkPages("Template:Taxonomy/Nephrozoa"):
+        if "/skip" in subpage:
+            output.append(subpage)
+    print(output)"""
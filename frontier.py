@@ -0,0 +1,53 @@
+import sqlite3
+
+
+# A disk-backed record of a crawl over large parts of the tree.
+# 'roots' holds the pages whose backlinks are being crawled (the starting points and any /skip templates found on the way),
+# along with the continuation of the next batch to ask for. 'pages' holds every template that has been visited.
+# Both use the name as the primary key, so anything found more than once is only ever stored and visited once.
+# Nothing is written until commit() is called, so the frontier can be kept in step with checkpoints of the tree.
+class Frontier:
+    def __init__(self, fileName="frontier.db"):
+        self.db = sqlite3.connect(fileName)
+        self.db.execute("CREATE TABLE IF NOT EXISTS roots (page TEXT PRIMARY KEY, cont TEXT NOT NULL DEFAULT '', done INTEGER NOT NULL DEFAULT 0)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS pages (title TEXT PRIMARY KEY, root TEXT)")
+        self.db.commit()
+
+    # Adds a page whose backlinks need crawling, returning whether it is new
+    def addRoot(self, page):
+        return self.db.execute("INSERT OR IGNORE INTO roots (page) VALUES (?)", (page,)).rowcount > 0
+
+    # Returns the next root that still has backlinks to crawl, along with its continuation, or None
+    def nextRoot(self):
+        return self.db.execute("SELECT page, cont FROM roots WHERE done = 0 ORDER BY rowid LIMIT 1").fetchone()
+
+    # Records where to carry on crawling a root's backlinks from, or that it is finished if there's nothing left
+    def setCursor(self, page, cont):
+        if cont == -1:
+            self.db.execute("UPDATE roots SET cont = '', done = 1 WHERE page = ?", (page,))
+        else:
+            self.db.execute("UPDATE roots SET cont = ? WHERE page = ?", (cont, page))
+
+    # Marks a template as visited, returning False if it had already been visited
+    def visit(self, title, root=""):
+        return self.db.execute("INSERT OR IGNORE INTO pages (title, root) VALUES (?, ?)", (title, root)).rowcount > 0
+
+    # Returns whether there is nothing left to do, i.e. the last crawl finished or there hasn't been one
+    def finished(self):
+        return self.nextRoot() is None
+
+    # Returns how many templates have been visited
+    def visited(self):
+        return self.db.execute("SELECT COUNT(*) FROM pages").fetchone()[0]
+
+    def commit(self):
+        self.db.commit()
+
+    # Empties the frontier, ready for a new crawl
+    def reset(self):
+        self.db.execute("DELETE FROM roots")
+        self.db.execute("DELETE FROM pages")
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,145 @@
+from datetime import datetime, timedelta
+from treeShape import childrenByParent
+
+# How far back edits count towards how busy a node is
+WINDOW_DAYS = 365
+# The shortest and longest time between checks of a node, in days
+MIN_INTERVAL = 1
+MAX_INTERVAL = 180
+# How many edits' worth of weight the rest of a node's family gets when working out how busy the node is,
+# so a quiet template in a busy group (e.g. birds) is checked more often than one in a quiet group
+FAMILY_WEIGHT = 2
+# How many edit times are kept for each node
+MAX_HISTORY = 20
+# How many titles can be checked per API request
+TITLES_PER_REQUEST = 50
+
+
+# Reads a timestamp like "2021-04-12T10:00:00Z", returning None for anything else (such as the dummy "" for missing pages)
+def parseTime(timestamp):
+    try:
+        return datetime.strptime(timestamp[:19], "%Y-%m-%dT%H:%M:%S")
+    except (TypeError, ValueError):
+        return None
+
+
+def formatTime(time):
+    return time.isoformat()[:19] + "Z"
+
+
+# Decides how often each node needs checking for edits, going by how often it and the nodes around it have been edited.
+# 'history' maps each node to the times of the edits seen to its taxonomy template, and 'lastChecked' maps each node to
+# when it was last checked. Both are plain dictionaries so they can be saved alongside the tree.
+# Requests are paid for out of 'credit', which builds up at the daily rate between runs, so running often doesn't use more
+# requests than running once a day. 'pending' holds nodes found out of date that there wasn't enough credit left to fetch.
+# The tree is passed in as a dictionary of nodes with a 'parent' attribute, so this doesn't depend on commonCladeSystem.
+class RefreshScheduler:
+    def __init__(self):
+        self.history = {}
+        self.lastChecked = {}
+        self.lastRun = None
+        self.credit = 0
+        self.pending = []
+
+    # Replaces the history with one that was saved, as returned by getState()
+    def load(self, state):
+        self.history = state.get("history", {})
+        self.lastChecked = state.get("lastChecked", {})
+        self.lastRun = state.get("lastRun")
+        self.credit = state.get("credit", 0)
+        self.pending = state.get("pending", [])
+
+    def getState(self):
+        return {"history": self.history, "lastChecked": self.lastChecked, "lastRun": self.lastRun, "credit": self.credit,
+                "pending": self.pending}
+
+    # Records the time of the latest edit of a node's template. Seeing the same edit again does nothing.
+    def recordRevision(self, name, timestamp):
+        if parseTime(timestamp) is None:
+            return
+        times = self.history.setdefault(name, [])
+        if timestamp not in times:
+            times.append(timestamp)
+            times.sort()
+            del times[:-MAX_HISTORY]
+
+    def recordCheck(self, name, time=None):
+        self.lastChecked[name] = formatTime(time or datetime.now())
+
+    def recordRun(self, time=None):
+        self.lastRun = formatTime(time or datetime.now())
+
+    # Adds the requests earned since the last run to the credit, at 'requestsPerDay', and records this run.
+    # Unused credit carries over between runs, but never more than a day's worth, so a long gap doesn't cause a burst.
+    # Returns the credit.
+    def earn(self, requestsPerDay, now=None):
+        now = now or datetime.now()
+        lastRun = parseTime(self.lastRun)
+        days = 1 if lastRun is None else max(0, (now - lastRun).total_seconds() / 86400)
+        self.credit = min(requestsPerDay, self.credit + requestsPerDay * days)
+        self.recordRun(now)
+        return self.credit
+
+    def spend(self, requests):
+        self.credit -= requests
+
+    # Returns when a node was last checked, falling back on when it was last updated, or None if it never was
+    def checkedAt(self, name, node):
+        time = parseTime(self.lastChecked.get(name))
+        if time is None:
+            time = parseTime(getattr(node, "lastUpdated", None))
+        return time
+
+    # Returns a dictionary of how many days there should be between checks of each node.
+    # Each node's edit rate is its own edits in the window plus FAMILY_WEIGHT times the average number of edits per node in
+    # its parent's subtree, and a node is due about when it is expected to have had half an edit since the last check.
+    def intervals(self, tree, now=None):
+        now = now or datetime.now()
+        start = now - timedelta(days=WINDOW_DAYS)
+        own = {}
+        for name, times in self.history.items():
+            if name in tree:
+                own[name] = sum(1 for time in times if (parseTime(time) or start) > start)
+
+        # Edits and sizes of every subtree, added up from the bottom, going by the nodes' parents
+        children = childrenByParent(tree)
+        edits = {}
+        sizes = {}
+        for root in [name for name in tree if tree[name].parent not in tree]:
+            stack = [(root, False)]
+            while stack:
+                name, finished = stack.pop()
+                if finished:
+                    edits[name] = own.get(name, 0) + sum(edits[child] for child in children.get(name, []))
+                    sizes[name] = 1 + sum(sizes[child] for child in children.get(name, []))
+                else:
+                    stack.append((name, True))
+                    stack.extend((child, False) for child in children.get(name, []))
+
+        output = {}
+        for name in sizes:
+            family = tree[name].parent if tree[name].parent in sizes else name
+            rate = (own.get(name, 0) + FAMILY_WEIGHT * edits[family] / sizes[family]) / WINDOW_DAYS
+            interval = 0.5 / rate if rate > 0 else MAX_INTERVAL
+            output[name] = min(max(interval, MIN_INTERVAL), MAX_INTERVAL)
+        return output
+
+    # Returns the nodes that are due a check, most overdue first, and no more than 'limit' of them if it is given.
+    # If checking everything as often as it needs would take more than 'requestsPerDay', every interval is stretched to fit.
+    def due(self, tree, requestsPerDay, now=None, skip=lambda name: False, limit=None):
+        now = now or datetime.now()
+        titlesPerDay = requestsPerDay * TITLES_PER_REQUEST
+        intervals = {name: interval for name, interval in self.intervals(tree, now).items() if not skip(name)}
+        stretch = max(1, sum(1 / interval for interval in intervals.values()) / titlesPerDay)
+
+        overdue = []
+        for name, interval in intervals.items():
+            checked = self.checkedAt(name, tree[name])
+            if checked is None:
+                overdue.append((float("inf"), name))
+                continue
+            ratio = (now - checked).total_seconds() / 86400 / (interval * stretch)
+            if ratio >= 1:
+                overdue.append((ratio, name))
+        overdue.sort(reverse=True)
+        return [name for ratio, name in overdue[:limit]]
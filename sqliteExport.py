@@ -0,0 +1,81 @@
+import sqlite3
+from datetime import datetime
+import commonCladeSystem as ccs
+
+EXPORT_FILE = "tree.db"
+
+
+# Returns the row for every node in the tree, worked out from the top down so each node's depth comes from its parent's
+def currentRows():
+    tree = ccs.treeDict
+    rows = {}
+    for root in [name for name in tree if tree[name].parent not in tree]:
+        stack = [(root, 0)]
+        while stack:
+            name, depth = stack.pop()
+            node = tree[name]
+            rows[name] = (node.rank, int(getattr(node, "extinct", False)), getattr(node, "commonName", ""),
+                          node.parent, depth, getattr(node, "lastUpdated", ""))
+            stack.extend((child, depth + 1) for child in ccs.treeChildren.childrenOf(name))
+    return rows
+
+
+# Returns every node below the given ones, including themselves, along with the chain of ancestors of each one
+def subtreesWithAncestors(names):
+    tree = ccs.treeDict
+    output = {}
+    for top in names:
+        if top in output:
+            continue
+        chain = []
+        parent = tree[top].parent
+        while parent in tree and parent not in chain:
+            chain.append(parent)
+            parent = tree[parent].parent
+        stack = [(top, tuple(chain))]
+        while stack:
+            name, ancestors = stack.pop()
+            output[name] = ancestors
+            stack.extend((child, (name,) + ancestors) for child in ccs.treeChildren.childrenOf(name))
+    return output
+
+
+# Writes the tree to a SQLite database with a 'nodes' table and an ancestor/descendant 'closure' table, so that
+# "everything under X" or "the lineage of Y" is a single indexed query, e.g.
+#   SELECT descendant FROM closure WHERE ancestor = 'Crocodilia'
+#   SELECT ancestor FROM closure WHERE descendant = 'Crocodylus' ORDER BY distance
+# If the database already exists, only the nodes that changed since the last export are rewritten, along with the
+# closure rows of anything below a node that was added or moved.
+def exportTree(fileName=EXPORT_FILE):
+    db = sqlite3.connect(fileName)
+    db.execute("CREATE TABLE IF NOT EXISTS nodes (name TEXT PRIMARY KEY, rank TEXT, extinct INTEGER, commonName TEXT, "
+               "parent TEXT, depth INTEGER, lastUpdated TEXT)")
+    db.execute("CREATE TABLE IF NOT EXISTS closure (ancestor TEXT NOT NULL, descendant TEXT NOT NULL, distance INTEGER NOT NULL, "
+               "PRIMARY KEY (ancestor, descendant)) WITHOUT ROWID")
+    db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+    db.execute("CREATE INDEX IF NOT EXISTS closureDescendant ON closure (descendant, distance)")
+    db.execute("CREATE INDEX IF NOT EXISTS nodesParent ON nodes (parent)")
+    db.execute("CREATE INDEX IF NOT EXISTS nodesRank ON nodes (rank)")
+
+    with ccs.treeLock.reading():
+        rows = currentRows()
+        old = {row[0]: tuple(row[1:]) for row in db.execute("SELECT * FROM nodes")}
+        deleted = [name for name in old if name not in rows]
+        changed = [name for name in rows if old.get(name) != rows[name]]
+        # A new or moved node changes the ancestors of everything below it
+        moved = [name for name in changed if name not in old or old[name][3] != rows[name][3]]
+        rewrite = subtreesWithAncestors(moved)
+
+    with db:
+        db.executemany("DELETE FROM nodes WHERE name = ?", [(name,) for name in deleted])
+        db.executemany("INSERT OR REPLACE INTO nodes VALUES (?, ?, ?, ?, ?, ?, ?)",
+                       [(name,) + rows[name] for name in changed])
+        db.executemany("DELETE FROM closure WHERE descendant = ?", [(name,) for name in deleted + list(rewrite)])
+        db.executemany("DELETE FROM closure WHERE ancestor = ?", [(name,) for name in deleted])
+        for name, ancestors in rewrite.items():
+            closureRows = [(name, name, 0)] + [(ancestor, name, distance + 1) for distance, ancestor in enumerate(ancestors)]
+            db.executemany("INSERT OR REPLACE INTO closure VALUES (?, ?, ?)", closureRows)
+        db.execute("INSERT OR REPLACE INTO meta VALUES ('lastExport', ?)", (datetime.now().isoformat()[:-7] + "Z",))
+        db.execute("INSERT OR REPLACE INTO meta VALUES ('treeLastUpdated', ?)", (ccs.lastUpdated,))
+    db.close()
+    print(f"Exported {str(len(changed))} changed nodes, removed {str(len(deleted))} and rewrote the closure of {str(len(rewrite))}")
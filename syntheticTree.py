@@ -0,0 +1,143 @@
+import random
+import time
+import tracemalloc
+import os
+import tempfile
+import commonCladeSystem as ccs
+from commonCladeSystem import Node
+
+# How often each rank is given to clades that have children. Clades without children are genera.
+defaultRankMix = {"clade": 8, "superfamily": 1, "family": 3, "subfamily": 2, "tribe": 1, "order": 1, "suborder": 1, "class": 0.2}
+
+
+# Makes a random taxonomy of 'size' nodes made of real Nodes, returning (treeDict, commonNames). The options are:
+#   branching - the average number of children of a clade that isn't in a chain
+#   chainRatio - the fraction of clades with exactly one child, which make the long chains seen in real lineages
+#   depthBias - how likely the next clade to get children is the newest one (making the tree deep), rather than a
+#               random one (making it bushy)
+#   rankMix - how often each rank is given to clades with children
+#   extinctRatio - the fraction of genera that are extinct. A clade is extinct if everything below it is.
+#   commonNameRatio - the fraction of nodes with a common name
+# The same seed always makes the same tree.
+def generateTree(size, branching=4, chainRatio=0.2, depthBias=0.5, rankMix=None, extinctRatio=0.3, commonNameRatio=0.05, seed=0):
+    if rankMix is None:
+        rankMix = defaultRankMix
+    rng = random.Random(seed)
+    tree = {"Life": Node("Life", ["Life"], "clade", False)}
+    commonNames = {}
+    unexpanded = ["Life"]  # Nodes that haven't been given children yet
+    count = 1
+    while count < size and unexpanded:
+        if rng.random() < depthBias:
+            parent = unexpanded.pop()
+        else:
+            position = rng.randrange(len(unexpanded))
+            unexpanded[position], unexpanded[-1] = unexpanded[-1], unexpanded[position]
+            parent = unexpanded.pop()
+        if rng.random() < chainRatio:
+            children = 1
+        else:
+            children = rng.randint(2, max(2, 2 * branching - 2))
+        parentNode = tree[parent]
+        for var in range(min(children, size - count)):
+            name = "Taxon" + str(count)
+            tree[name] = Node(name, [name] + parentNode.cladeList, "genus", False)
+            parentNode.addChild(name)
+            unexpanded.append(name)
+            count += 1
+
+    # Ranks and extinct status depend on which nodes ended up with children, so they're worked out from the bottom up
+    ranks = list(rankMix)
+    weights = [rankMix[rank] for rank in ranks]
+    for name in reversed(list(tree)):
+        node = tree[name]
+        if len(node.children) > 0:
+            node.setRank(rng.choices(ranks, weights)[0])
+            node.setExtinct(all(tree[child].extinct for child in node.children))
+        else:
+            node.setExtinct(rng.random() < extinctRatio)
+        if rng.random() < commonNameRatio:
+            node.setCommonName("Common " + name)
+            commonNames[node.commonName] = name
+    return tree, commonNames
+
+
+# Loads a tree made by generateTree in place of the current one, so everything in commonCladeSystem works on it.
+# runHarness puts the real tree back afterwards.
+def useTree(tree, commonNames):
+    ccs.loadData(("2000-01-01T00:00:00Z", tree, commonNames, {}))
+
+
+# Runs a function, returning what it returns, and stores how long it took in result[name], in seconds, and the peak memory
+# traced while it ran in result[name + "Memory"]. tracemalloc has to be running. Before Python 3.9 the peak can't be
+# reset, so it is the peak since tracing started instead.
+def measure(result, name, function, *args, **kwargs):
+    if hasattr(tracemalloc, "reset_peak"):
+        tracemalloc.reset_peak()
+    start = time.perf_counter()
+    output = function(*args, **kwargs)
+    result[name] = time.perf_counter() - start
+    result[name + "Memory"] = tracemalloc.get_traced_memory()[1]
+    return output
+
+
+measures = ["generate", "save", "load", "report", "filteredReport", "countGenera", "checkTree"]
+
+
+# Measures a synthetic tree of each size: the time taken to make, save and load it and to run whole-tree traversals, and
+# the peak memory of each of those (with tracemalloc, which slows everything down by about the same factor). Times are
+# also given per node, so anything growing faster than the tree shows up as a per node figure that rises with the size.
+# Returns a list of dictionaries of results, one per size.
+# The synthetic trees are loaded in place of the real tree, which is put back (along with the crawl state, negative cache
+# and refresh schedule) when this finishes, even if it fails, so the real tree can't be saved over with a synthetic one.
+def runHarness(sizes=(10000, 100000, 1000000), **options):
+    results = []
+    folder = tempfile.mkdtemp()
+    fileName = os.path.join(folder, "synthetic.txt")
+    reportName = os.path.join(folder, "report.txt")
+    wasLoaded = ccs.treeLoaded
+    lastUpdated, treeDict, commonNames, extraData = ccs.currentData()
+    saved = (lastUpdated, treeDict, commonNames, dict(extraData, negativeCache=dict(extraData["negativeCache"])))
+    try:
+        for size in sizes:
+            result = {"size": size}
+            tracemalloc.start()
+            tree, synthetic = measure(result, "generate", generateTree, size, **options)
+            result["cladeListEntries"] = sum(len(node.cladeList) for node in tree.values())
+            useTree(tree, synthetic)
+            del tree, synthetic
+
+            measure(result, "save", ccs.saveTree, fileName)
+            result["fileSize"] = os.path.getsize(fileName)
+            measure(result, "load", lambda: useTree(*ccs.readTreeFile(fileName)[1:3]))
+            measure(result, "report", ccs.fileTreeReport, "Life", fileName=reportName)
+            measure(result, "filteredReport", ccs.fileTreeReport, "Life", predicate=ccs.hasCommonName, fileName=reportName)
+            measure(result, "countGenera", ccs.countGenera, "Life")
+            measure(result, "checkTree", ccs.checkTree)
+            tracemalloc.stop()
+            result["peakMemory"] = max(result[name + "Memory"] for name in measures)
+            results.append(result)
+            printResult(result)
+    finally:
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        ccs.loadData(saved)
+        ccs.treeLoaded = wasLoaded
+        for name in [fileName, reportName]:
+            if os.path.exists(name):
+                os.remove(name)
+        os.rmdir(folder)
+    return results
+
+
+def printResult(result):
+    size = result["size"]
+    print(f"{str(size)} nodes: {result['peakMemory'] / 2 ** 20:.1f} MB peak ({result['peakMemory'] / size:.0f} bytes per node, "
+          f"{result['cladeListEntries'] / size:.1f} cladeList entries per node), {result['fileSize'] / 2 ** 20:.1f} MB saved")
+    for name in measures:
+        print(f"\t{name}: {result[name]:.3f}s ({result[name] / size * 1e6:.2f}µs per node), "
+              f"{result[name + 'Memory'] / 2 ** 20:.1f} MB peak")
+
+
+if __name__ == "__main__":
+    runHarness()
@@ -0,0 +1,130 @@
+import mwparserfromhell as mw
+import re
+
+# Everything needed to read taxon data out of wikitext. Nothing here touches the tree or the network, so it can be
+# run in worker processes by extractRecords without them loading the tree.
+
+# Wikipedia uses latin names for ranks in their templates, so this is needed when anglicising rank names.
+replacements = {
+    "regnum": "kingdom",
+    "cladus": "clade",
+    "classis": "class",
+    "familia": "family",
+    "ordo": "order",
+    "tribus": "tribe",
+    "divisio": "division",
+}
+
+
+# Removes dumb characters from the pagename like spaces or newlines
+def cleanPageName(pageName):
+    pageName = pageName.replace("/?", "")
+    pageName = pageName.replace("?", "")
+    pageName = pageName.replace("/displayed", "")
+    pageName = pageName.replace("/skip", "")
+    pageName = pageName.replace("/Class", "")
+    pageName = pageName.replace("\r", "")
+    pageName = pageName.replace("/\"", "")
+    pageName = pageName.replace("_", " ")
+    pageName = re.sub("[Ii]ncertae [sc]edis/", "", pageName) # Different spellings of Incertae sedis
+    pageName = re.sub("<.*>", "", pageName)  # Removes HTML comments as well as HTML tags
+    pageName = re.sub("<.*", "", pageName)  # In case splitting splits on an = inside the tags
+    pageName = pageName.strip()
+    return pageName
+
+
+# Removes dumb characters from the rank, then anglicises it
+def cleanRank(rank):
+    rank = rank.strip()
+    rank = re.sub("<!--.*-->", "", rank)
+    for rep in replacements:
+        rank = rank.replace(rep, replacements[rep])
+    return rank
+
+
+# Returns the value of a specified parameter from a page that has already been parsed
+def taxonDataFromPage(page, data):
+    temps = page.filter_templates()
+    for t in temps:
+        if t.has(data):
+            param = t.get(data)
+            paramData = param.split("=")[1]
+            return paramData
+
+
+# Returns the value of the 'extinct' parameter from a page that has already been parsed
+def extinctFromPage(page):
+    temps = page.filter_templates()
+    temp = ""
+    found = False
+    for t in temps:
+        if t.has("extinct"):
+            temp = t
+            found = True
+            break
+    if found:
+        param = temp.get("extinct").lower()
+        paramData = cleanPageName(param.split("=")[1])
+    return found and (paramData == "yes" or paramData == "true")
+
+
+# Returns (genus, species, subspecies, extinct) from a parsed page with a speciesbox or subspeciesbox on it, or None if it has neither
+# 'subspecies' is blank for species
+def speciesFromPage(page):
+    temps = page.filter_templates()
+    for t in temps:
+        name = cleanPageName(str(t.name))
+        if name.lower() == "speciesbox":  # TODO: Check for speciesboxes with the subgenus parameter
+            if t.has("taxon"):
+                param = t.get("taxon")
+                paramData = cleanPageName(param.split("=")[1])
+                genus = paramData.split()[0]
+                species = paramData.split()[1]
+            else:
+                param1 = t.get("genus")
+                param2 = t.get("species")
+                genus = cleanPageName(param1.split("=")[1])
+                species = cleanPageName(param2.split("=")[1])
+            return genus, species, "", t.has("extinct")
+        elif name.lower() == "subspeciesbox":
+            # Wikipedia says subspeciesbox requires the taxon in parts
+            param1 = t.get("genus")
+            param2 = t.get("species")
+            param3 = t.get("subspecies")
+            genus = cleanPageName(param1.split("=")[1])
+            species = cleanPageName(param2.split("=")[1])
+            subspecies = cleanPageName(param3.split("=")[1])
+            return genus, species, subspecies, t.has("extinct")
+
+
+# Reads everything the tree needs from the wikitext of a page, returning it as a plain dictionary, which is much smaller
+# to send between processes than the parsed page. 'parent', 'rank', 'extinct' and 'link' come from a taxonomy template,
+# and 'species' is (genus, species, subspecies, extinct) from a speciesbox or subspeciesbox, or None if there isn't one.
+# Anything missing is None, and if the page can't be read, 'error' says why.
+def extractRecord(title, text):
+    record = {"title": title, "parent": None, "rank": None, "extinct": False, "link": None, "species": None,
+              "redirect": None, "error": None}
+    try:
+        page = mw.parse(text)
+        m = re.search(r"#redirect\s*\[\[(.*)\]\]", text, re.IGNORECASE)
+        if m is not None:
+            record["redirect"] = m.group(1)
+        parent = taxonDataFromPage(page, "parent")
+        if parent is not None:
+            record["parent"] = cleanPageName(parent)
+        rank = taxonDataFromPage(page, "rank")
+        if rank is not None:
+            record["rank"] = cleanRank(rank)
+        link = taxonDataFromPage(page, "link")
+        if link is not None:
+            record["link"] = cleanPageName(link)
+        record["extinct"] = extinctFromPage(page)
+        record["species"] = speciesFromPage(page)
+    except (AttributeError, ValueError, IndexError) as e:
+        record["error"] = f"{type(e).__name__}: {e}"
+    return record
+
+
+# Runs extractRecord on a list of (title, text) pairs, for handing a whole batch of pages to a worker process at once
+def extractRecords(pages):
+    return [extractRecord(title, text) for title, text in pages]
@@ -0,0 +1,160 @@
+import numpy as np
+import commonCladeSystem as ccs
+
+
+# A copy of the tree stored as parallel NumPy arrays, so that questions about large parts of the tree can be answered
+# with a few vectorised passes instead of walking the nodes one by one.
+# Every node gets an index, and each array holds one value per index:
+# parent (-1 for the root), depth, rankCode (an index into 'ranks'), extinct, pre and post (pre-order and post-order
+# positions) and size (the number of nodes in the subtree, including the node itself).
+# A node's descendants are exactly the nodes whose pre-order position is in [pre, pre + size).
+class TreeArrays:
+    def __init__(self):
+        self.stale = True
+        self.build()
+        ccs.addChangeListener(self.onChange)
+
+    # Builds every array from treeDict in O(n)
+    def build(self):
+        tree = ccs.treeDict
+        self.names = list(tree)
+        self.index = {name: i for i, name in enumerate(self.names)}
+        count = len(self.names)
+
+        self.ranks = []
+        rankCodes = {}
+        parent = np.full(count, -1, dtype=np.int32)
+        rankCode = np.zeros(count, dtype=np.int16)
+        extinct = np.zeros(count, dtype=bool)
+        for i, name in enumerate(self.names):
+            node = tree[name]
+            parent[i] = self.index.get(node.parent, -1)
+            if node.rank not in rankCodes:
+                rankCodes[node.rank] = len(self.ranks)
+                self.ranks.append(node.rank)
+            rankCode[i] = rankCodes[node.rank]
+            extinct[i] = getattr(node, "extinct", False)
+
+        # An iterative depth first search down the parent pointers (through ccs.treeChildren, which keeps the order of each
+        # node's children list), so positions match the reports and nodes missing from their parent's children are reached
+        depth = np.zeros(count, dtype=np.int32)
+        pre = np.full(count, -1, dtype=np.int32)
+        post = np.full(count, -1, dtype=np.int32)
+        size = np.ones(count, dtype=np.int32)
+        preCounter = 0
+        postCounter = 0
+        for root in np.flatnonzero(parent == -1):
+            stack = [(int(root), False)]
+            while stack:
+                i, finished = stack.pop()
+                if finished:
+                    post[i] = postCounter
+                    postCounter += 1
+                    size[i] = preCounter - pre[i]
+                    continue
+                if pre[i] != -1:
+                    continue
+                pre[i] = preCounter
+                preCounter += 1
+                stack.append((i, True))
+                for child in reversed(ccs.treeChildren.childrenOf(self.names[i])):
+                    j = self.index[child]
+                    if pre[j] == -1:
+                        depth[j] = depth[i] + 1
+                        stack.append((j, False))
+
+        self.rankCodes = rankCodes
+        self.parent = parent
+        self.rankCode = rankCode
+        self.extinct = extinct
+        self.depth = depth
+        self.pre = pre
+        self.post = post
+        self.size = size
+        self.order = np.argsort(pre)[count - preCounter:]  # Node indices in pre-order, leaving out anything unreachable
+        self.stale = False
+
+    # Anything that changes the shape of the tree or a node's rank or extinct status means the arrays need rebuilding
+    def onChange(self, change, name, old=None):
+        if change != "commonName":
+            self.stale = True
+
+    # Rebuilds the arrays if the tree has changed since they were last built
+    def refresh(self):
+        if self.stale:
+            self.build()
+        return self
+
+    # Returns a boolean mask of the nodes with the given rank
+    def rankMask(self, rank):
+        if rank not in self.rankCodes:
+            return np.zeros(len(self.names), dtype=bool)
+        return self.rankCode == self.rankCodes[rank]
+
+    # Returns a boolean mask of the given node and everything below it.
+    # A node that can't be reached from a root (i.e. one in a loop of parents) only gets itself.
+    def subtreeMask(self, name):
+        i = self.index[name]
+        if self.pre[i] == -1:
+            mask = np.zeros(len(self.names), dtype=bool)
+            mask[i] = True
+            return mask
+        return (self.pre >= self.pre[i]) & (self.pre < self.pre[i] + self.size[i])
+
+    # Returns, for every node, how many nodes in its subtree (including itself) are set in the given mask
+    def subtreeCounts(self, mask):
+        sums = np.zeros(len(self.order) + 1, dtype=np.int64)
+        np.cumsum(mask[self.order], out=sums[1:])
+        counts = np.zeros(len(self.names), dtype=np.int64)
+        reachable = self.pre != -1
+        counts[reachable] = sums[self.pre[reachable] + self.size[reachable]] - sums[self.pre[reachable]]
+        return counts
+
+    # Returns a dictionary of how many nodes of each rank there are, optionally only under a given node
+    def rankHistogram(self, root=None, mask=None):
+        selected = np.ones(len(self.names), dtype=bool) if mask is None else mask.copy()
+        if root is not None:
+            selected &= self.subtreeMask(root)
+        counts = np.bincount(self.rankCode[selected], minlength=len(self.ranks))
+        return {self.ranks[code]: int(counts[code]) for code in np.flatnonzero(counts)}
+
+    # Returns a dictionary of how many nodes there are at each depth, optionally only for one rank and/or under a given node
+    def depthDistribution(self, rank=None, root=None):
+        selected = np.ones(len(self.names), dtype=bool) if rank is None else self.rankMask(rank)
+        if root is not None:
+            selected &= self.subtreeMask(root)
+        counts = np.bincount(self.depth[selected])
+        return {int(depth): int(counts[depth]) for depth in np.flatnonzero(counts)}
+
+    # Counts the nodes of 'targetRank' under each node of 'groupRank' that is below 'root'
+    # e.g. countPerGroup("Aves", "family", "genus", extantOnly=True) gives the number of extant genera in each bird family
+    def countPerGroup(self, root, groupRank, targetRank, extantOnly=False):
+        target = self.rankMask(targetRank)
+        if extantOnly:
+            target &= ~self.extinct
+        counts = self.subtreeCounts(target)
+        groups = np.flatnonzero(self.rankMask(groupRank) & self.subtreeMask(root))
+        return {self.names[i]: int(counts[i]) for i in groups}
+
+    # Returns, for every node, how many extinct and how many extant nodes are in its subtree
+    def extinctRollup(self):
+        return self.subtreeCounts(self.extinct), self.subtreeCounts(~self.extinct)
+
+    # Returns the clades that have descendants, none of which are extant, optionally only under a given node
+    def extinctOnlyClades(self, root=None):
+        extantBelow = self.subtreeCounts(~self.extinct) - ~self.extinct
+        selected = (self.size > 1) & (extantBelow == 0)
+        if root is not None:
+            selected &= self.subtreeMask(root)
+        return [self.names[i] for i in np.flatnonzero(selected)]
+
+
+shared = None
+
+
+# Returns an up to date TreeArrays for the current tree, building it the first time this is called
+def getArrays():
+    global shared
+    if shared is None:
+        shared = TreeArrays()
+    return shared.refresh()
@@ -0,0 +1,163 @@
+import hashlib
+from collections import Counter
+import commonCladeSystem as ccs
+from treeShape import childrenByParent
+
+
+# Returns the data of a node that counts towards its hash. Old saves don't have every attribute, so defaults are used.
+def nodeData(node):
+    return node.rank, getattr(node, "extinct", False), getattr(node, "commonName", "")
+
+
+# Returns the names of the nodes at the top of a tree, i.e. those whose parent isn't in it
+def rootsOf(tree):
+    return [name for name in tree if tree[name].parent not in tree]
+
+
+# Works out a hash for every subtree from the node's name, rank, extinct status, common name and its children's hashes.
+# Two subtrees with the same hash are identical, so the diff never has to look inside them.
+def subtreeHashes(tree, children=None):
+    if children is None:
+        children = childrenByParent(tree)
+    hashes = {}
+    for root in rootsOf(tree):
+        stack = [(root, False)]
+        while stack:
+            name, finished = stack.pop()
+            if finished:
+                digest = hashlib.blake2b(repr((name,) + nodeData(tree[name])).encode(), digest_size=16)
+                for childHash in sorted(hashes[child] for child in children[name]):
+                    digest.update(childHash)
+                hashes[name] = digest.digest()
+            else:
+                stack.append((name, True))
+                stack.extend((child, False) for child in children[name])
+    return hashes
+
+
+# Compares two trees, returning a dictionary of lists of changes:
+# 'added' and 'removed' hold (name, parent) pairs, 'moved' holds (name, old parent, new parent),
+# 'reranked', 'extinct' and 'commonName' hold (name, old value, new value) and 'renamed' holds (old name, new name).
+# Subtrees with matching hashes are skipped, so the work done is proportional to the part of the tree that changed.
+def diffTrees(oldTree, newTree, oldHashes=None, newHashes=None):
+    oldChildMap = childrenByParent(oldTree)
+    newChildMap = childrenByParent(newTree)
+    if oldHashes is None:
+        oldHashes = subtreeHashes(oldTree, oldChildMap)
+    if newHashes is None:
+        newHashes = subtreeHashes(newTree, newChildMap)
+    result = {"added": [], "removed": [], "moved": [], "reranked": [], "extinct": [], "commonName": [], "renamed": []}
+
+    toCompare = []  # Nodes in both trees whose subtrees might differ
+    appeared = []  # (name, parent) for nodes that aren't under the same parent in the old tree
+    disappeared = []  # (name, parent) for nodes that aren't under the same parent in the new tree
+    oldRoots = rootsOf(oldTree)
+    newRoots = rootsOf(newTree)
+    for root in newRoots:
+        if root in oldRoots:
+            toCompare.append(root)
+        else:
+            appeared.append((root, ""))
+    for root in oldRoots:
+        if root not in newRoots:
+            disappeared.append((root, ""))
+
+    while toCompare or appeared or disappeared:
+        while toCompare:
+            name = toCompare.pop()
+            if oldHashes.get(name) == newHashes.get(name):
+                continue
+            oldRank, oldExtinct, oldCommon = nodeData(oldTree[name])
+            newRank, newExtinct, newCommon = nodeData(newTree[name])
+            if oldRank != newRank:
+                result["reranked"].append((name, oldRank, newRank))
+            if oldExtinct != newExtinct:
+                result["extinct"].append((name, oldExtinct, newExtinct))
+            if oldCommon != newCommon:
+                result["commonName"].append((name, oldCommon, newCommon))
+
+            oldChildren = oldChildMap[name]
+            newChildren = newChildMap[name]
+            oldSet = set(oldChildren)
+            newSet = set(newChildren)
+            for child in newChildren:
+                if child in oldSet:
+                    toCompare.append(child)
+                else:
+                    appeared.append((child, name))
+            for child in oldChildren:
+                if child not in newSet:
+                    disappeared.append((child, name))
+
+        while appeared:
+            name, parent = appeared.pop()
+            if name in oldTree:
+                result["moved"].append((name, oldTree[name].parent, parent))
+                toCompare.append(name)
+            else:
+                result["added"].append((name, parent))
+                appeared.extend((child, name) for child in newChildMap[name])
+
+        while disappeared:
+            name, parent = disappeared.pop()
+            # Anything still in the new tree has been moved, and is picked up when it appears under its new parent
+            if name not in newTree:
+                result["removed"].append((name, parent))
+                disappeared.extend((child, name) for child in oldChildMap[name])
+
+    findRenames(result, oldChildMap)
+    for changes in result.values():
+        changes.sort()
+    return result
+
+
+# A renamed taxon shows up as a removed node and an added node, with the removed node's children moving to the added one.
+# Pairs where most of the old node's children moved to the new one are reported as renames instead.
+def findRenames(result, oldChildMap):
+    removed = {name for name, parent in result["removed"]}
+    added = {name for name, parent in result["added"]}
+    pairs = Counter((oldParent, newParent) for name, oldParent, newParent in result["moved"]
+                    if oldParent in removed and newParent in added)
+    renames = {}
+    taken = set()
+    for (oldName, newName), count in pairs.most_common():
+        if oldName in renames or newName in taken:
+            continue
+        if count * 2 >= len(oldChildMap[oldName]):
+            renames[oldName] = newName
+            taken.add(newName)
+
+    result["renamed"] = list(renames.items())
+    result["moved"] = [move for move in result["moved"] if renames.get(move[1]) != move[2]]
+    result["removed"] = [pair for pair in result["removed"] if pair[0] not in renames]
+    result["added"] = [pair for pair in result["added"] if pair[0] not in taken]
+
+
+# Compares two saved trees, e.g. tree.txt and a file in Backup/
+def diffFiles(oldFile, newFile):
+    return diffTrees(ccs.readTreeFile(oldFile)[1], ccs.readTreeFile(newFile)[1])
+
+
+# Compares a saved tree with the tree that is currently loaded
+def diffWithCurrent(oldFile):
+    return diffTrees(ccs.readTreeFile(oldFile)[1], ccs.treeDict)
+
+
+# Prints out the changes found by diffTrees
+def printDiff(result):
+    for name, parent in result["added"]:
+        print(f"Added {name} under {parent}")
+    for name, parent in result["removed"]:
+        print(f"Removed {name} from {parent}")
+    for name, oldParent, newParent in result["moved"]:
+        print(f"Moved {name} from {oldParent} to {newParent}")
+    for oldName, newName in result["renamed"]:
+        print(f"Renamed {oldName} to {newName}")
+    for name, oldRank, newRank in result["reranked"]:
+        print(f"Changed the rank of {name} from {oldRank} to {newRank}")
+    for name, oldExtinct, newExtinct in result["extinct"]:
+        print(f"{name} is now {'extinct' if newExtinct else 'extant'}")
+    for name, oldCommon, newCommon in result["commonName"]:
+        print(f"Changed the common name of {name} from '{oldCommon}' to '{newCommon}'")
+    counts = ", ".join(f"{len(result[change])} {change}" for change in result)
+    print(f"Total: {counts}")
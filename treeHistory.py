@@ -0,0 +1,186 @@
+import sqlite3
+import pickle
+import zlib
+import json
+
+HISTORY_FILE = "history.db"
+# A full copy of the tree is stored every this many versions, so rebuilding an old tree never replays more than this many changesets
+CHECKPOINT_EVERY = 20
+
+
+# Returns what the history keeps of each node: (parent, rank, extinct, common name)
+# Old saves don't have every attribute, so defaults are used.
+def snapshot(tree):
+    return {name: (node.parent, node.rank, bool(getattr(node, "extinct", False)), getattr(node, "commonName", ""))
+            for name, node in tree.items()}
+
+
+# Returns the list of changes between two snapshots, as (name, kind, old, new).
+# 'added' and 'removed' have the whole of the node's snapshot as their new or old value, and
+# 'moved', 'rank', 'extinct' and 'commonName' have the old and new parent, rank, extinct status or common name.
+def changesBetween(old, new):
+    changes = []
+    for name, data in new.items():
+        if name not in old:
+            changes.append((name, "added", None, data))
+            continue
+        oldData = old[name]
+        if oldData == data:
+            continue
+        for position, kind in enumerate(["moved", "rank", "extinct", "commonName"]):
+            if oldData[position] != data[position]:
+                changes.append((name, kind, oldData[position], data[position]))
+    for name, data in old.items():
+        if name not in new:
+            changes.append((name, "removed", data, None))
+    return changes
+
+
+# Applies a list of changes from changesBetween to a snapshot, changing it in place
+def applyChanges(state, changes):
+    for name, kind, old, new in changes:
+        if kind == "added":
+            state[name] = tuple(new)
+        elif kind == "removed":
+            state.pop(name, None)
+        else:
+            data = list(state[name])
+            data[["moved", "rank", "extinct", "commonName"].index(kind)] = new
+            state[name] = tuple(data)
+
+
+# A record of every saved version of the tree, stored in SQLite as a changeset against the version before it, with a full
+# copy of the tree every CHECKPOINT_EVERY versions. 'versions' lists each version's date, 'checkpoints' holds the
+# compressed full copies and 'events' holds every change, indexed by taxon, so the history of one taxon is a single query.
+# This doesn't depend on commonCladeSystem, so trees are passed in and the Node class is passed in to rebuild them.
+class TreeHistory:
+    def __init__(self, fileName=HISTORY_FILE):
+        # Saves can come from an update thread as well as the main one
+        self.db = sqlite3.connect(fileName, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS versions (id INTEGER PRIMARY KEY, date TEXT UNIQUE NOT NULL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS checkpoints (version INTEGER PRIMARY KEY, data BLOB NOT NULL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS events (version INTEGER NOT NULL, name TEXT NOT NULL, kind TEXT NOT NULL, "
+                        "old TEXT, new TEXT)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS eventsName ON events (name, version)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS eventsVersion ON events (version)")
+        self.db.commit()
+        self.latest = None  # The snapshot of the latest version, kept once it's been worked out
+
+    # Returns the id and date of every version, oldest first
+    def versions(self):
+        return self.db.execute("SELECT id, date FROM versions ORDER BY id").fetchall()
+
+    # Returns the id of the latest version on or before the given date, or None if there isn't one
+    def versionAt(self, date):
+        row = self.db.execute("SELECT id FROM versions WHERE date <= ? ORDER BY id DESC LIMIT 1", (date,)).fetchone()
+        return None if row is None else row[0]
+
+    # Returns the snapshot of the tree at the given version, replaying changesets from the nearest checkpoint before it
+    def stateAt(self, version):
+        row = self.db.execute("SELECT version, data FROM checkpoints WHERE version <= ? ORDER BY version DESC LIMIT 1",
+                              (version,)).fetchone()
+        if row is None:
+            return {}
+        state = pickle.loads(zlib.decompress(row[1]))
+        changes = self.db.execute("SELECT name, kind, old, new FROM events WHERE version > ? AND version <= ? ORDER BY rowid",
+                                  (row[0], version))
+        applyChanges(state, [(name, kind, json.loads(old), json.loads(new)) for name, kind, old, new in changes])
+        return state
+
+    # Records a version of the tree from the given date, storing only what changed since the last version.
+    # Dates have to be later than the latest version's; use insert() for older trees. Returns how many changes there were.
+    # An empty tree is never recorded, as it can only come from a tree that wasn't loaded.
+    def record(self, date, tree):
+        if len(tree) == 0:
+            print(f"Not recording the tree as of {date}, as it is empty")
+            return 0
+        state = snapshot(tree)
+        rows = self.versions()
+        if len(rows) > 0 and date <= rows[-1][1]:
+            print(f"Not recording the tree as of {date}, as the history already goes up to {rows[-1][1]}")
+            return 0
+        if self.latest is None:
+            self.latest = self.stateAt(rows[-1][0]) if len(rows) > 0 else {}
+        changes = changesBetween(self.latest, state)
+        if len(rows) > 0 and len(changes) == 0:
+            return 0
+
+        with self.db:
+            version = self.db.execute("INSERT INTO versions (date) VALUES (?)", (date,)).lastrowid
+            self.db.executemany("INSERT INTO events VALUES (?, ?, ?, ?, ?)",
+                                [(version, name, kind, json.dumps(old), json.dumps(new)) for name, kind, old, new in changes])
+            # A large changeset costs about as much to replay as a checkpoint costs to load, so it gets a checkpoint as well
+            if len(rows) % CHECKPOINT_EVERY == 0 or len(changes) * 4 > len(state):
+                self.db.execute("INSERT INTO checkpoints VALUES (?, ?)",
+                                (version, zlib.compress(pickle.dumps(state, pickle.HIGHEST_PROTOCOL))))
+        self.latest = state
+        return len(changes)
+
+    # Adds trees from any date, e.g. old backups, as a list of (date, tree) pairs.
+    # Every version is rebuilt and the history is recorded again in date order, so this is slow for long histories.
+    def insert(self, trees):
+        states = {date: self.stateAt(version) for version, date in self.versions()}
+        for date, tree in trees:
+            states[date] = snapshot(tree)
+        with self.db:
+            self.db.execute("DELETE FROM versions")
+            self.db.execute("DELETE FROM checkpoints")
+            self.db.execute("DELETE FROM events")
+        self.latest = {}
+        for date in sorted(states):
+            self.recordSnapshot(date, states[date])
+
+    # The same as record, for a tree that has already been through snapshot()
+    def recordSnapshot(self, date, state):
+        return self.record(date, {name: SnapshotNode(data) for name, data in state.items()})
+
+    # Rebuilds the tree as it was on the given date, returning (treeDict, commonNames), or None if the history doesn't go back that far.
+    # 'nodeClass' is the Node class to build the tree from.
+    def treeAsOf(self, date, nodeClass):
+        version = self.versionAt(date)
+        if version is None:
+            return None
+        state = self.stateAt(version)
+
+        children = {}
+        for name, data in state.items():
+            children.setdefault(data[0], []).append(name)
+        tree = {}
+        commonNames = {}
+        for root in [name for name in state if state[name][0] not in state]:
+            stack = [(root, [root, state[root][0]] if state[root][0] != "" else [root])]
+            while stack:
+                name, cladeList = stack.pop()
+                parent, rank, extinct, commonName = state[name]
+                node = nodeClass(name, cladeList, rank, extinct)
+                node.setParent(parent)
+                if commonName != "":
+                    node.setCommonName(commonName)
+                    commonNames[commonName] = name
+                node.children = list(children.get(name, []))
+                tree[name] = node
+                stack.extend((child, [child] + cladeList) for child in children.get(name, []))
+        return tree, commonNames
+
+    # Returns every change to a taxon as (date, kind, old value, new value), oldest first
+    def taxonHistory(self, name):
+        rows = self.db.execute("SELECT versions.date, kind, old, new FROM events JOIN versions ON events.version = versions.id "
+                               "WHERE name = ? ORDER BY events.version", (name,))
+        return [(date, kind, json.loads(old), json.loads(new)) for date, kind, old, new in rows]
+
+    # Returns the dates when a taxon was put under the given parent, by being moved there or added there
+    def whenMoved(self, name, parent):
+        output = []
+        for date, kind, old, new in self.taxonHistory(name):
+            if (kind == "moved" and new == parent) or (kind == "added" and new[0] == parent):
+                output.append(date)
+        return output
+
+    def close(self):
+        self.db.close()
+
+
+# Stands in for a Node when recording a snapshot that was already taken, so record() can take it like a tree
+class SnapshotNode:
+    def __init__(self, data):
+        self.parent, self.rank, self.extinct, self.commonName = data
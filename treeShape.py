@@ -0,0 +1,17 @@
+# Works out the shape of a tree given as a dictionary of nodes with 'parent' and 'children' attributes. This doesn't
+# depend on commonCladeSystem, so modules that don't import it (like refreshScheduler) can use it too.
+
+
+# Returns a dictionary of each node's children, going by the nodes' parents rather than by their lists of children, which
+# can miss nodes after old updates (see checkTree). Each node's children are in the order of its list, followed by any
+# it's missing. Nodes whose parent isn't in the tree are listed under it as well, so the roots are under "".
+def childrenByParent(tree):
+    children = {}
+    for name, node in tree.items():
+        children[name] = [child for child in dict.fromkeys(getattr(node, "children", []))
+                          if child in tree and tree[child].parent == name]
+    listed = {name: set(childList) for name, childList in children.items()}
+    for name, node in tree.items():
+        if name not in listed.get(node.parent, ()):
+            children.setdefault(node.parent, []).append(name)
+    return children